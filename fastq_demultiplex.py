@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+#
+# fastq_demultiplex - split pooled FASTQ with inline barcodes into samples, optionally filtering to FASTA
+#
+# Version: 0.4 (5/21/2016)
+#
+# Part of rRNA_pipeline - FASTQ filtering, and swarm OTU classification of 16/18S barcodes
+#
+# Original version: 4/11/2016 John P. McCrow (jmccrow [at] jcvi.org)
+# J. Craig Venter Institute (JCVI)
+# La Jolla, CA USA
+#
+# Barcodes are matched at the start of each read (R1) and trimmed.  All barcode variants within
+# the allowed mismatches are precomputed into one hash table per barcode length, so each read
+# costs one lookup per length.  Variants equally close to two barcodes are left unassigned, and
+# barcodes within the allowed mismatches of each other (over the shorter length) are an error.
+#
+# With --filter, each assigned read goes straight through the fastq_filter rules and is written
+# to <sample>.filtered.fa, so the pooled file is streamed once and never rewritten per sample.
+#
+import sys, re, os, getopt
+import happyfile
+import fastq_filter
+
+verbose = False
+
+buffer_size = 262144
+list_barcode_samples = []
+dict_length_table = {}
+dict_sample_writers = {}
+dict_sample_reads = {}
+count_total = 0
+count_unassigned = 0
+
+class SampleWriter:
+    # per-sample output buffered in memory, appended to the file when full so no handle stays open
+    def __init__(self, filename):
+        self.filename = filename
+        self.lines = []
+        self.size = 0
+        self.started = False
+
+    def write(self, s):
+        self.lines.append(s)
+        self.size += len(s)
+        if self.size >= buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.lines or not self.started:
+            out_handle = open(self.filename, ('w', 'a')[self.started])
+            out_handle.write("".join(self.lines))
+            out_handle.close()
+            self.started = True
+            self.lines = []
+            self.size = 0
+
+    def close(self):
+        self.flush()
+
+def barcode_variants(barcode, mismatches):
+    dict_variant_dist = {barcode : 0}
+    last_variants = [barcode]
+    for dist in range(1, mismatches + 1):
+        next_variants = []
+        for v in last_variants:
+            for i in range(len(v)):
+                for c in "ACGTN":
+                    variant = v[:i] + c + v[i+1:]
+                    if not variant in dict_variant_dist:
+                        dict_variant_dist[variant] = dist
+                        next_variants.append(variant)
+        last_variants = next_variants
+    return dict_variant_dist
+
+def read_barcodes(barcodes_file):
+    global list_barcode_samples
+
+    in_handle = happyfile.hopen_or_else(barcodes_file)
+
+    if verbose:
+        print >>sys.stderr, "Reading barcodes file: " + barcodes_file
+
+    while 1:
+        line = in_handle.readline()
+        if not line:
+            break
+        line = line.rstrip()
+
+        if line:
+            name, barcode = line.split("\t")[:2]
+            for sample, other in list_barcode_samples:
+                if sample == name:
+                    print >>sys.stderr, "Duplicate sample name found: " + name
+                    sys.exit(2)
+            list_barcode_samples.append((name, barcode.upper()))
+
+    in_handle.close()
+
+def barcode_collisions(mismatches):
+    # (sample, sample, mismatches) for barcode pairs close enough to share variants, over the shorter length
+    list_collisions = []
+    for i in range(len(list_barcode_samples)):
+        name1, barcode1 = list_barcode_samples[i]
+        for name2, barcode2 in list_barcode_samples[:i]:
+            length = min(len(barcode1), len(barcode2))
+            dist = sum(1 for k in range(length) if barcode1[k] != barcode2[k])
+            if dist <= mismatches or (dist <= 2 * mismatches and len(barcode1) == len(barcode2)):
+                list_collisions.append((name2, name1, dist))
+    return list_collisions
+
+def build_barcode_tables(mismatches):
+    global dict_length_table
+
+    failed = False
+    for name1, name2, dist in barcode_collisions(mismatches):
+        if dist <= mismatches:
+            print >>sys.stderr, "Barcodes of samples " + name1 + " and " + name2 + " are " + str(dist) + " mismatches apart, within the allowed " + str(mismatches)
+            failed = True
+        elif verbose:
+            print >>sys.stderr, "Reads equally close to barcodes of samples " + name1 + " and " + name2 + " are left unassigned"
+    if failed:
+        sys.exit(2)
+
+    # variant -> (distance, sample), with None for variants equally close to two barcodes
+    dict_length_table = {}
+    for name, barcode in list_barcode_samples:
+        table = dict_length_table.setdefault(len(barcode), {})
+        dict_variant_dist = barcode_variants(barcode, mismatches)
+        for variant in dict_variant_dist:
+            dist = dict_variant_dist[variant]
+            if not variant in table or dist < table[variant][0]:
+                table[variant] = (dist, name)
+            elif dist == table[variant][0]:
+                table[variant] = (dist, None)
+
+    for length in dict_length_table:
+        table = dict_length_table[length]
+        for variant in list(table):
+            if table[variant][1] is None:
+                del table[variant]
+            else:
+                table[variant] = table[variant][1]
+
+def assign_sample(seq):
+    prefix = seq.upper()
+    for length in sorted(dict_length_table, reverse=True):
+        sample = dict_length_table[length].get(prefix[:length])
+        if sample:
+            return sample, length
+    return None, 0
+
+def open_writers(output_dir, do_filter, paired):
+    for name, barcode in list_barcode_samples:
+        if do_filter:
+            dict_sample_writers[name] = (SampleWriter(os.path.join(output_dir, name + ".filtered.fa")),)
+        elif paired:
+            dict_sample_writers[name] = (SampleWriter(os.path.join(output_dir, name + "_R1.fastq")), SampleWriter(os.path.join(output_dir, name + "_R2.fastq")))
+        else:
+            dict_sample_writers[name] = (SampleWriter(os.path.join(output_dir, name + ".fastq")),)
+
+def close_writers():
+    for name in dict_sample_writers:
+        for writer in dict_sample_writers[name]:
+            writer.close()
+
+def demultiplex_fastq(fastq_file1, fastq_file2, output_dir, do_filter, min_quality, min_seq_len, max_seq_len, min_entropy):
+    global count_total
+    global count_unassigned
+
+    in_handle1 = happyfile.hopen_or_else(fastq_file1)
+    in_handle2 = None
+    if fastq_file2:
+        in_handle2 = happyfile.hopen_or_else(fastq_file2)
+
+    if verbose:
+        print >>sys.stderr, "Reading pooled FASTQ file: " + fastq_file1
+        if fastq_file2:
+            print >>sys.stderr, "Reading pooled FASTQ file: " + fastq_file2
+
+    open_writers(output_dir, do_filter, fastq_file2 != "")
+
+    while 1:
+        record1 = [in_handle1.readline().rstrip() for i in range(4)]
+        if not record1[0]:
+            break
+        if in_handle2:
+            record2 = [in_handle2.readline().rstrip() for i in range(4)]
+
+        count_total += 1
+        sample, length = assign_sample(record1[1])
+        if not sample:
+            count_unassigned += 1
+            continue
+        dict_sample_reads[sample] = dict_sample_reads.get(sample, 0) + 1
+
+        seq = record1[1][length:]
+        qual = record1[3][length:]
+        writers = dict_sample_writers[sample]
+        if do_filter:
+            id = re.split('\s', record1[0][1:])[0]
+            fastq_filter.filter_line(writers[0], id, seq, qual, min_quality, min_seq_len, max_seq_len, min_entropy)
+        else:
+            print >>writers[0], "\n".join([record1[0], seq, record1[2], qual])
+            if in_handle2:
+                print >>writers[1], "\n".join(record2)
+
+    if fastq_filter.list_batch:
+        fastq_filter.filter_batch(min_entropy)
+
+    in_handle1.close()
+    if in_handle2:
+        in_handle2.close()
+    close_writers()
+
+def write_summary(summary_file):
+    out_handle = sys.stderr
+    if summary_file:
+        out_handle = happyfile.hopen_write_or_else(summary_file)
+
+    if verbose and summary_file:
+        print >>sys.stderr, "Writing summary file: " + summary_file
+
+    print >>out_handle, "\t".join(['sample', 'barcode', 'reads'])
+    for name, barcode in list_barcode_samples:
+        print >>out_handle, "\t".join([name, barcode, str(dict_sample_reads.get(name, 0))])
+    print >>out_handle, "\t".join(['unassigned', '', str(count_unassigned)])
+
+    if summary_file:
+        out_handle.close()
+
+def test_barcodes():
+    global list_barcode_samples
+    global dict_length_table
+    retval = True
+    list_barcode_samples = [('s1', 'ACGTAC'), ('s2', 'ACTTTC'), ('s3', 'GGATCCAA')]
+    build_barcode_tables(1)
+    exact = assign_sample("acgtacgggg")
+    mismatch = assign_sample("GGTTCCAAGGGG")
+    ambiguous = assign_sample("ACGTTCGGGG")
+    collisions = barcode_collisions(1)
+    list_barcode_samples = [('s1', 'ACGTAC'), ('s2', 'ACGTAC'), ('s3', 'ACGTTC'), ('s4', 'GGATCCAA'), ('s5', 'GGATCC')]
+    duplicates = barcode_collisions(1)
+    if exact == ('s1', 6) and mismatch == ('s3', 8) and ambiguous == (None, 0) and len(barcode_variants("ACGT", 1)) == 1 + 4 * 4 and collisions == [('s1', 's2', 2)] and duplicates == [('s1', 's2', 0), ('s1', 's3', 1), ('s2', 's3', 1), ('s4', 's5', 0)]:
+        print >>sys.stderr, "[fastq_demultiplex] test_barcodes: passed"
+    else:
+        print >>sys.stderr, "[fastq_demultiplex] test_barcodes: failed"
+        retval = False
+    return retval
+
+def test_all():
+    if not test_barcodes():
+        sys.exit(2)
+
+###
+
+def main(argv):
+    help = "\n".join([
+        "fastq_demultiplex v0.4 (May 21, 2016)",
+        "Demultiplex pooled FASTQ by inline barcodes",
+        "",
+        "Usage: " + os.path.basename(argv[0]) + " (options)",
+        "   -f file        : pooled FASTQ file, barcodes at read start (required)",
+        "   -r file        : pooled FASTQ file R2 (paired, without --filter)",
+        "   -b file        : barcodes file, tab-delimited (sample, barcode) (required)",
+        "   -n int         : maximum barcode mismatches (default: 1)",
+        "   -d dir         : output folder (default: .)",
+        "   -s file        : output summary of reads per sample (default: stderr)",
+        "   --filter       : filter reads, output <sample>.filtered.fa",
+        "   -c file        : usearch -uchime_ref output for pooled reads (--filter)",
+        "   -q int         : minimum quality score (--filter, default: 30)",
+        "   -m int         : minimim sequence length (--filter, default: 50)",
+        "   -x int         : maximum sequence length (--filter, default: Inf)",
+        "   -e float       : minimum triplet entropy, low complexity filter (--filter, default: 0, off)",
+        "   -h, --help     : help",
+        "   -v, --verbose  : more information to stderr", ""])
+
+    global verbose
+    fastq_file1 = ""
+    fastq_file2 = ""
+    barcodes_file = ""
+    output_dir = "."
+    summary_file = ""
+    chimera_file = ""
+    do_filter = False
+    mismatches = 1
+    min_quality = 30
+    min_seq_len = 50
+    max_seq_len = float("Inf")
+    min_entropy = 0
+
+    try:
+        opts, args = getopt.getopt(argv[1:], "f:r:b:n:d:s:c:q:m:x:e:hv", ["filter", "help", "verbose", "test"])
+    except getopt.GetoptError:
+        print >>sys.stderr, help
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print >>sys.stderr, help
+            sys.exit()
+        elif opt == '--test':
+            test_all()
+            sys.exit()
+        elif opt == '-f':
+            fastq_file1 = arg
+        elif opt == '-r':
+            fastq_file2 = arg
+        elif opt == '-b':
+            barcodes_file = arg
+        elif opt == '-n':
+            mismatches = int(re.sub('=','', arg))
+        elif opt == '-d':
+            output_dir = arg
+        elif opt == '-s':
+            summary_file = arg
+        elif opt == '--filter':
+            do_filter = True
+        elif opt == '-c':
+            chimera_file = arg
+        elif opt == '-q':
+            min_quality = int(re.sub('=','', arg))
+        elif opt == '-m':
+            min_seq_len = int(re.sub('=','', arg))
+        elif opt == '-x':
+            max_seq_len = int(re.sub('=','', arg))
+        elif opt == '-e':
+            min_entropy = float(re.sub('=','', arg))
+        elif opt in ("-v", "--verbose"):
+            verbose = True
+
+    if not (fastq_file1 and barcodes_file):
+        print >>sys.stderr, help
+        sys.exit(2)
+
+    if do_filter and fastq_file2:
+        print >>sys.stderr, help + "\nPaired FASTQ (-r) must be merged before --filter"
+        sys.exit(2)
+
+    if verbose:
+        print >>sys.stderr, "\n".join([
+            "pooled fastq file:  " + fastq_file1,
+            "pooled fastq R2:    " + fastq_file2,
+            "barcodes file:      " + barcodes_file,
+            "max mismatches:     " + str(mismatches),
+            "output folder:      " + output_dir,
+            "filter reads:       " + ("no", "yes")[do_filter],
+            "chimera file:       " + chimera_file])
+
+    read_barcodes(barcodes_file)
+    build_barcode_tables(mismatches)
+
+    if chimera_file:
+        fastq_filter.read_chimeras(chimera_file)
+
+    demultiplex_fastq(fastq_file1, fastq_file2, output_dir, do_filter, min_quality, min_seq_len, max_seq_len, min_entropy)
+    write_summary(summary_file)
+
+    if verbose and count_total:
+        print >>sys.stderr, "reads total:      " + str(count_total)
+        print >>sys.stderr, "reads unassigned: " + str(count_unassigned) + " (" + str(round(100.0*count_unassigned/count_total, 1)) + "%)"
+        if do_filter:
+            print >>sys.stderr, "reads passed:     " + str(fastq_filter.count_passed) + " (" + str(round(100.0*fastq_filter.count_passed/count_total, 1)) + "%)"
+
+if __name__ == "__main__":
+    main(sys.argv)
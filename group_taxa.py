@@ -12,6 +12,7 @@
 #
 import sys, re, os, getopt
 import happyfile
+import happymatrix
 
 verbose = False
 
@@ -50,30 +51,18 @@ def read_taxa_counts(swarm_tax_file):
     global dict_group_sample_counts
     global sample_list
     
-    in_handle = happyfile.hopen_or_else(swarm_tax_file)
+    counts_reader = happymatrix.CountsReader(swarm_tax_file, 2)
     
     if verbose:
         print >>sys.stderr, "Reading taxa counts file: " + swarm_tax_file
     
-    firstline = 1
-    while 1:
-        line = in_handle.readline()
-        if not line:
-            break
-        line = line.rstrip()
-        
-        if firstline:
-            sample_list = line.split("\t")[3:]
-        else:
-            cols = line.split("\t")
-            taxstr = cols[2]
-            for i in range(3, len(cols)):
-                dict_taxa_sample_counts[taxstr, i-3] = dict_taxa_sample_counts.get((taxstr, i-3), 0) + int(cols[i])
-                dict_taxa_counts[taxstr] = dict_taxa_counts.get(taxstr, 0) + int(cols[i])
-        
-        firstline = 0
-            
-    in_handle.close()
+    sample_list = counts_reader.col_names
+    for swarm_id, fields, items in counts_reader.rows():
+        taxstr = fields[1]
+        dict_taxa_counts[taxstr] = dict_taxa_counts.get(taxstr, 0)
+        for i, count in items:
+            dict_taxa_sample_counts[taxstr, i] = dict_taxa_sample_counts.get((taxstr, i), 0) + count
+            dict_taxa_counts[taxstr] += count
 
     for id_tax in dict_taxa_counts:
         best_grp_tax = ""
@@ -90,27 +79,15 @@ def read_taxa_counts(swarm_tax_file):
             dict_group_counts[best_grp_name] = dict_group_counts.get(best_grp_name, 0) + dict_taxa_counts.get(id_tax, 0)
 
 def write_group_counts(output_groups_file):
-    out_handle = sys.stdout
-    if output_groups_file:
-        out_handle = happyfile.hopen_write_or_else(output_groups_file)
+    counts_writer = happymatrix.CountsWriter(output_groups_file, list(sample_list), ['group'])
 
     if verbose and output_groups_file:
         print >>sys.stderr, "Writing group counts file: " + output_groups_file
 
-    column_names = ['group']
-    for name in sample_list:
-        column_names.append(name)
-
-    print >>out_handle, "\t".join(column_names)
-
     for group_name in sorted(dict_group_counts, key=lambda x: dict_group_counts.get(x), reverse=True):
-        samplecounts = [group_name]
-        for i in range(len(sample_list)):
-            samplecounts.append(dict_group_sample_counts.get((group_name, i), 0))
-        print >>out_handle, "\t".join(str(x) for x in samplecounts)
+        counts_writer.write_row(group_name, [(i, dict_group_sample_counts.get((group_name, i), 0)) for i in range(len(sample_list))])
 
-    if output_groups_file:
-        out_handle.close()
+    counts_writer.close()
 
 def test_all():
     print >>sys.stderr, "[group_taxa] test_all: passed"
@@ -123,9 +100,9 @@ def main(argv):
         "merge OTU counts by taxonomic groups",
         "",
         "Usage: " + os.path.basename(argv[0]) + " (options)",
-        "   -f file        : swarm taxonomy file",
+        "   -f file        : swarm taxonomy file (TSV or .npz)",
         "   -g file        : taxonomic groups file",
-        "   -o file        : output group counts file (default: stdout)",
+        "   -o file        : output group counts file, .npz for sparse binary (default: stdout)",
         "   -h, --help     : help",
         "   -v, --verbose  : more information to stderr", ""])
 
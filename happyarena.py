@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+## happyarena - Unique sequences packed in one bytes arena with an offset index
+## Part of rRNA_pipeline
+#
+# 1. Sequences are appended to a single growable bytearray; offsets[i]..offsets[i+1] is sequence i,
+#    so each sequence costs its raw length plus an 8-byte offset, rather than a Python str object.
+#
+# 2. Sequence -> index lookup is an open-addressing hash table of (index + 1) in a flat array,
+#    rebuilt as needed, so no per-sequence dict keys are held either.
+#
+# 3. An arena can be saved to a file and opened again memory-mapped (read-only), so worker
+#    processes can share it without copying.  The hash table of a mapped arena is built on first lookup.
+#
+
+import mmap, struct
+import happymatrix
+
+arena_magic = b"RRARENA1"
+arena_header = "=8sQQ"
+
+if str is bytes:
+    def to_bytes(seq):
+        return seq
+    def to_str(data):
+        return str(data)
+else:
+    def to_bytes(seq):
+        return seq.encode('ascii')
+    def to_str(data):
+        return data.decode('ascii')
+
+class SeqArena:
+    def __init__(self, data=None, offsets=None, base=0):
+        if data is None:
+            data = bytearray()
+            offsets = happymatrix.int64_array(1)
+        self.data = data
+        self.offsets = offsets
+        self.base = base
+        self.table = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def seq_bytes(self, i):
+        return self.data[self.base + self.offsets[i]:self.base + self.offsets[i+1]]
+
+    def __getitem__(self, i):
+        return to_str(self.seq_bytes(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield to_str(self.seq_bytes(i))
+
+    def build_table(self, size=16):
+        while size < 2 * len(self):
+            size *= 2
+        self.table = happymatrix.int64_array(size)
+        for i in range(len(self)):
+            self.insert_slot(self.seq_bytes(i), i)
+
+    def insert_slot(self, seq_bytes, index):
+        mask = len(self.table) - 1
+        slot = hash(bytes(seq_bytes)) & mask
+        while self.table[slot]:
+            slot = (slot + 1) & mask
+        self.table[slot] = index + 1
+
+    def index(self, seq):
+        # index of seq, or -1
+        if self.table is None:
+            self.build_table()
+        seq_bytes = to_bytes(seq)
+        table = self.table
+        mask = len(table) - 1
+        slot = hash(seq_bytes) & mask
+        while table[slot]:
+            i = table[slot] - 1
+            if self.offsets[i+1] - self.offsets[i] == len(seq_bytes) and self.seq_bytes(i) == seq_bytes:
+                return i
+            slot = (slot + 1) & mask
+        return -1
+
+    def append(self, seq):
+        # appends seq without checking for duplicates, returns its index
+        seq_bytes = to_bytes(seq)
+        index = len(self)
+        self.data += seq_bytes
+        self.offsets.append(len(self.data))
+        if self.table is not None:
+            if 2 * len(self) > len(self.table):
+                self.build_table(2 * len(self.table))
+            else:
+                self.insert_slot(seq_bytes, index)
+        return index
+
+    def add(self, seq):
+        # index of seq, appended if new; returns (index, is_new)
+        index = self.index(seq)
+        if index >= 0:
+            return index, False
+        return self.append(seq), True
+
+    def save(self, arena_file):
+        out_handle = open(arena_file, 'wb')
+        out_handle.write(struct.pack(arena_header, arena_magic, len(self), self.offsets[-1]))
+        if hasattr(self.offsets, 'tobytes'):
+            out_handle.write(self.offsets.tobytes())
+        else:
+            out_handle.write(self.offsets.tostring())
+        if self.base == 0 and len(self.data) == self.offsets[-1]:
+            out_handle.write(self.data)
+        else:
+            out_handle.write(self.data[self.base:self.base + self.offsets[-1]])
+        out_handle.close()
+
+def load_arena(arena_file):
+    # read-only arena over a memory map of a saved arena file
+    in_handle = open(arena_file, 'rb')
+    mm = mmap.mmap(in_handle.fileno(), 0, access=mmap.ACCESS_READ)
+    in_handle.close()
+    magic, num_seqs, data_size = struct.unpack(arena_header, mm[:struct.calcsize(arena_header)])
+    if magic != arena_magic:
+        raise ValueError("not a sequence arena: " + arena_file)
+    start = struct.calcsize(arena_header)
+    offsets = happymatrix.int64_array()
+    if hasattr(offsets, 'frombytes'):
+        offsets.frombytes(mm[start:start + 8 * (num_seqs + 1)])
+    else:
+        offsets.fromstring(mm[start:start + 8 * (num_seqs + 1)])
+    if offsets[-1] != data_size:
+        raise ValueError("truncated sequence arena: " + arena_file)
+    return SeqArena(mm, offsets, start + 8 * (num_seqs + 1))
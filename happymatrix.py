@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+#
+## happymatrix - Sparse sample count matrices held in flat arrays
+## Part of rRNA_pipeline
+#
+# 1. Counts are collected as COO triplets (row, column, count) appended to arrays,
+#    and converted once to CSR (indptr, indices, data) for row-wise access.
+#
+# 2. Only non-zero cells are stored, so memory and time scale with the number of
+#    non-zero (row, sample) pairs, not rows x samples.
+#
+# 3. Row sums and per-row non-zero counts are single passes over the CSR arrays.
+#
+# 4. Rows are summed into groups (e.g. amplicons into OTUs) by a counting sort of rows by group,
+#    then one pass over each group's non-zero cells.
+#
+# 5. Count tables are read and written as TSV, or as a sparse .npz when the file name ends in .npz.
+#    The .npz holds the CSR arrays under scipy.sparse.save_npz names (data, indices, indptr, shape,
+#    format), plus row_names, col_names, and one field_<name> array per text column (e.g. taxonomy),
+#    so it loads with scipy.sparse.load_npz or numpy.load, but needs neither to be read or written.
+#
+
+import array, sys, ast, zipfile
+import happyfile
+
+# 64-bit signed integer array typecode ('l' is 64-bit on LP64 systems, 'q' elsewhere)
+int64_typecode = 'l'
+if array.array('l').itemsize != 8:
+    int64_typecode = 'q'
+
+def int64_array(size=0):
+    return array.array(int64_typecode, [0]) * size
+
+def int32_array(size=0):
+    return array.array('i', [0]) * size
+
+class CountsCOO:
+    def __init__(self):
+        self.rows = int64_array()
+        self.cols = int32_array()
+        self.data = int64_array()
+
+    def append(self, row, col, count):
+        self.rows.append(row)
+        self.cols.append(col)
+        self.data.append(count)
+
+    def __len__(self):
+        return len(self.data)
+
+class CountsMatrix:
+    def __init__(self, nrows, ncols, indptr, indices, data):
+        self.nrows = nrows
+        self.ncols = ncols
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    def row_items(self, i):
+        start, end = self.indptr[i], self.indptr[i+1]
+        return zip(self.indices[start:end], self.data[start:end])
+
+    def row_dense(self, i):
+        counts = [0] * self.ncols
+        for col, count in self.row_items(i):
+            counts[col] += count
+        return counts
+
+    def row_sums(self):
+        sums = int64_array(self.nrows)
+        data = self.data
+        indptr = self.indptr
+        for i in range(self.nrows):
+            sums[i] = sum(data[indptr[i]:indptr[i+1]])
+        return sums
+
+    def row_nnz(self):
+        indptr = self.indptr
+        return array.array('i', [indptr[i+1] - indptr[i] for i in range(self.nrows)])
+
+def coo_to_csr(coo, nrows, ncols):
+    # counting sort of triplets by row, keeping column order within each row
+    indptr = int64_array(nrows + 1)
+    for row in coo.rows:
+        indptr[row+1] += 1
+    for i in range(nrows):
+        indptr[i+1] += indptr[i]
+
+    fill = indptr[:-1]
+    indices = int32_array(len(coo))
+    data = int64_array(len(coo))
+    for row, col, count in zip(coo.rows, coo.cols, coo.data):
+        pos = fill[row]
+        indices[pos] = col
+        data[pos] = count
+        fill[row] = pos + 1
+
+    return CountsMatrix(nrows, ncols, indptr, indices, data)
+
+def group_rows(matrix, row_groups, ngroups):
+    # sums the rows of each group (row_groups[i] is the group of row i, or -1 to leave it out)
+    # into a CSR matrix of ngroups rows, touching only non-zero cells
+    group_ptr = int64_array(ngroups + 1)
+    for g in row_groups:
+        if g >= 0:
+            group_ptr[g+1] += 1
+    for g in range(ngroups):
+        group_ptr[g+1] += group_ptr[g]
+    fill = group_ptr[:-1]
+    members = int64_array(group_ptr[-1])
+    for row in range(len(row_groups)):
+        g = row_groups[row]
+        if g >= 0:
+            members[fill[g]] = row
+            fill[g] += 1
+
+    indptr = int64_array(ngroups + 1)
+    indices = int32_array()
+    data = int64_array()
+    sums = int64_array(matrix.ncols)
+    mark = int64_array(matrix.ncols)
+    for g in range(ngroups):
+        start, end = group_ptr[g], group_ptr[g+1]
+        if end - start == 1:
+            row = members[start]
+            indices += matrix.indices[matrix.indptr[row]:matrix.indptr[row+1]]
+            data += matrix.data[matrix.indptr[row]:matrix.indptr[row+1]]
+        elif end > start:
+            cols = []
+            for row in members[start:end]:
+                for k in range(matrix.indptr[row], matrix.indptr[row+1]):
+                    col = matrix.indices[k]
+                    if mark[col] != g + 1:
+                        mark[col] = g + 1
+                        sums[col] = matrix.data[k]
+                        cols.append(col)
+                    else:
+                        sums[col] += matrix.data[k]
+            cols.sort()
+            for col in cols:
+                indices.append(col)
+                data.append(sums[col])
+        indptr[g+1] = len(data)
+
+    return CountsMatrix(ngroups, matrix.ncols, indptr, indices, data)
+
+def is_npz(counts_file):
+    return counts_file.endswith(".npz")
+
+def npy_encode(values, descr, shape):
+    header = "{'descr': '" + descr + "', 'fortran_order': False, 'shape': " + repr(shape) + ", }"
+    header += " " * (63 - (len(header) + 10) % 64) + "\n"
+    if isinstance(values, array.array):
+        if sys.byteorder == 'big':
+            values = array.array(values.typecode, values)
+            values.byteswap()
+        if hasattr(values, 'tobytes'):
+            data = values.tobytes()
+        else:
+            data = values.tostring()
+    else:
+        data = values
+    return b"\x93NUMPY\x01\x00" + bytes(bytearray([len(header) % 256, len(header) // 256])) + header.encode('latin-1') + data
+
+def npy_strings(strings):
+    # numpy '<U' arrays: fixed-width UTF-32 little-endian
+    encoded = [(s if isinstance(s, type(u"")) else s.decode('utf-8')).encode('utf-32-le') for s in strings]
+    width = max([len(e) for e in encoded] + [4])
+    return npy_encode(b"".join(e + b"\x00" * (width - len(e)) for e in encoded), '<U' + str(width // 4), (len(strings),))
+
+def npy_decode(data):
+    if data[:6] != b"\x93NUMPY":
+        raise ValueError("not a .npy array")
+    major = bytearray(data[6:7])[0]
+    if major == 1:
+        header_len = bytearray(data[8:10])
+        header_len = header_len[0] + 256 * header_len[1]
+        start = 10
+    else:
+        header_len = bytearray(data[8:12])
+        header_len = header_len[0] + 256 * header_len[1] + 65536 * header_len[2] + 16777216 * header_len[3]
+        start = 12
+    header = ast.literal_eval(data[start:start+header_len].decode('latin-1'))
+    descr = header['descr']
+    body = data[start+header_len:]
+
+    if descr[1] == 'U':
+        width = int(descr[2:]) * 4
+        strings = []
+        for i in range(0, len(body), width):
+            s = body[i:i+width].decode('utf-32-le').rstrip(u"\x00")
+            strings.append(s if str is type(u"") else s.encode('utf-8'))
+        return strings
+    if descr[1] == 'S':
+        return body
+
+    typecode = {'i4' : 'i', 'u4' : 'I', 'i8' : int64_typecode, 'u8' : int64_typecode.upper(), 'f8' : 'd'}.get(descr[1:])
+    if not typecode:
+        raise ValueError("unsupported .npy type: " + descr)
+    values = array.array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(body)
+    else:
+        values.fromstring(body)
+    if descr[0] == '>' or (descr[0] == '<') != (sys.byteorder == 'little'):
+        values.byteswap()
+    if typecode == 'd':
+        values = int64_array() + array.array(int64_typecode, [int(x) for x in values])
+    return values
+
+def save_npz(npz_file, matrix, row_names, col_names, row_fields=[]):
+    out_zip = zipfile.ZipFile(npz_file, 'w', zipfile.ZIP_DEFLATED)
+    out_zip.writestr("indices.npy", npy_encode(matrix.indices, array_descr(matrix.indices), (len(matrix.indices),)))
+    out_zip.writestr("indptr.npy", npy_encode(matrix.indptr, array_descr(matrix.indptr), (len(matrix.indptr),)))
+    out_zip.writestr("format.npy", npy_encode(b"csr", '|S3', ()))
+    out_zip.writestr("shape.npy", npy_encode(array.array(int64_typecode, [matrix.nrows, matrix.ncols]), array_descr(matrix.indptr), (2,)))
+    out_zip.writestr("data.npy", npy_encode(matrix.data, array_descr(matrix.data), (len(matrix.data),)))
+    out_zip.writestr("row_names.npy", npy_strings(row_names))
+    out_zip.writestr("col_names.npy", npy_strings(col_names))
+    out_zip.writestr("field_names.npy", npy_strings([name for name, values in row_fields]))
+    for name, values in row_fields:
+        out_zip.writestr("field_" + name + ".npy", npy_strings(values))
+    out_zip.close()
+
+def load_npz(npz_file):
+    try:
+        in_zip = zipfile.ZipFile(npz_file)
+    except (IOError, zipfile.BadZipfile):
+        print >>sys.stderr, "Unable to open file: " + npz_file
+        sys.exit(2)
+    arrays = {}
+    for name in in_zip.namelist():
+        arrays[name[:-4]] = npy_decode(in_zip.read(name))
+    in_zip.close()
+
+    if arrays.get('format', b"csr") != b"csr":
+        print >>sys.stderr, "Sparse matrix is not CSR: " + npz_file
+        sys.exit(2)
+    nrows, ncols = arrays['shape']
+    matrix = CountsMatrix(nrows, ncols, arrays['indptr'], arrays['indices'], arrays['data'])
+    row_names = arrays.get('row_names', [str(i) for i in range(nrows)])
+    col_names = arrays.get('col_names', [str(i) for i in range(ncols)])
+    row_fields = [(name, arrays['field_' + name]) for name in arrays.get('field_names', [])]
+    return matrix, row_names, col_names, row_fields
+
+def array_descr(values):
+    # arrays are written little-endian
+    return '<i' + str(values.itemsize)
+
+class CountsWriter:
+    # rows of (name, text fields, sparse (column, count) items), written as TSV or collected into a .npz
+    def __init__(self, counts_file, col_names, header_names=['id'], header=True):
+        self.counts_file = counts_file
+        self.col_names = col_names
+        self.header_names = header_names
+        self.sparse = is_npz(counts_file)
+        if self.sparse:
+            self.row_names = []
+            self.row_fields = [[] for name in header_names[1:]]
+            self.indptr = int64_array(1)
+            self.indices = int32_array()
+            self.data = int64_array()
+        else:
+            self.out_handle = sys.stdout
+            if counts_file:
+                self.out_handle = happyfile.hopen_write_or_else(counts_file)
+            if header:
+                print >>self.out_handle, "\t".join(header_names + col_names)
+
+    def write_row(self, name, items, fields=[]):
+        if self.sparse:
+            self.row_names.append(name)
+            for i in range(len(fields)):
+                self.row_fields[i].append(fields[i])
+            for col, count in items:
+                if count:
+                    self.indices.append(col)
+                    self.data.append(count)
+            self.indptr.append(len(self.data))
+        else:
+            counts = [0] * len(self.col_names)
+            for col, count in items:
+                counts[col] += count
+            print >>self.out_handle, "\t".join([name] + list(fields) + [str(x) for x in counts])
+
+    def close(self):
+        if self.sparse:
+            matrix = CountsMatrix(len(self.row_names), len(self.col_names), self.indptr, self.indices, self.data)
+            save_npz(self.counts_file, matrix, self.row_names, self.col_names, list(zip(self.header_names[1:], self.row_fields)))
+        elif self.counts_file:
+            self.out_handle.close()
+
+class CountsReader:
+    # rows of a TSV or .npz count table as (name, text fields, non-zero (column, count) items)
+    def __init__(self, counts_file, num_fields=0):
+        self.counts_file = counts_file
+        self.sparse = is_npz(counts_file)
+        if self.sparse:
+            self.matrix, self.row_names, self.col_names, row_fields = load_npz(counts_file)
+            self.field_names = [name for name, values in row_fields]
+            self.field_values = [values for name, values in row_fields]
+        else:
+            self.in_handle = happyfile.hopen_or_else(counts_file)
+            cols = self.in_handle.readline().rstrip().split("\t")
+            self.field_names = cols[1:1+num_fields]
+            self.col_names = cols[1+num_fields:]
+            self.num_fields = num_fields
+
+    def rows(self):
+        if self.sparse:
+            for i in range(self.matrix.nrows):
+                yield self.row_names[i], [values[i] for values in self.field_values], self.matrix.row_items(i)
+        else:
+            start = 1 + self.num_fields
+            while 1:
+                line = self.in_handle.readline()
+                if not line:
+                    break
+                cols = line.rstrip().split("\t")
+                yield cols[0], cols[1:start], [(i - start, int(cols[i])) for i in range(start, len(cols)) if cols[i] != "0"]
+            self.in_handle.close()
@@ -25,6 +25,10 @@ cpus = 1
 verbose = False
 overwrite = False
 do_chimera_search = True
+chimera_engine = "usearch"
+recruit_rare = False
+derep_parallel = False
+swarm_engine = "swarm"
 
 def xstr(s):
     if s is None:
@@ -88,6 +92,34 @@ def get_seq_file_pairs(fastq_dir):
             if m2:
                 list_seq_file_pairs.append(SequenceFilePair(f1, '', False))
 
+def get_demux_file_pairs(barcodes_file, demux_dir):
+    global list_seq_file_pairs
+    list_seq_file_pairs = []
+
+    in_handle = happyfile.hopen_or_else(barcodes_file)
+    while 1:
+        line = in_handle.readline()
+        if not line:
+            break
+        line = line.rstrip()
+
+        if line:
+            name = line.split("\t")[0]
+            fp = SequenceFilePair(name, '', False)
+            fp.basefile = name
+            fp.filtered = os.path.join(demux_dir, name + ".filtered.fa")
+            list_seq_file_pairs.append(fp)
+    in_handle.close()
+
+def write_demux_names(output_base_file):
+    # demultiplexed samples are named by their barcodes file names, not their FASTA paths
+    names_file = output_base_file + ".demux.names"
+    out_handle = happyfile.hopen_write_or_else(names_file)
+    for fp in list_seq_file_pairs:
+        print >>out_handle, fp.basefile + "\t" + fp.filtered
+    out_handle.close()
+    return names_file
+
 def run_command(name, checkfile, cmd_exe, cmd_params, redirect_all):
     if overwrite or not os.path.exists(checkfile):
         print >>sys.stderr, "[rRNA_pipeline] running " + name + " " + checkfile
@@ -123,17 +155,37 @@ def run_usearch(fp, database_file):
         # create empty file, so that step will be skipped, but reported
         open(fp.chimera, 'a').close()
 
-    run_command('chimera', fp.chimera, "usearch", cmd_params, True)
+    if chimera_engine == "native":
+        run_chimera_ref(fp, database_file)
+    else:
+        run_command('chimera', fp.chimera, "usearch", cmd_params, True)
+
+def run_chimera_ref(fp, database_file):
+    cmd_params = " ".join(["-t", str(cpus), "-f", fp.pear, "-d", database_file, "-o", fp.chimera])
+
+    run_command('chimera', fp.chimera, os.path.join(prog_dir, "chimera_ref.py"), cmd_params, False)
 
 def run_filter(fp, min_quality_score):
     cmd_params = " ".join(["-f", fp.pear, "-o", fp.filtered, "-c", fp.chimera, "-q", str(min_quality_score)])
     
     run_command('filter', fp.filtered, os.path.join(prog_dir, "fastq_filter.py"), cmd_params, False)
 
+def run_demultiplex(fp, barcodes_file, min_quality_score):
+    demux_summary = fp.basefile + ".demux"
+    # per-sample filtered FASTA files are written next to the pooled FASTQ
+    demux_dir = os.path.dirname(fp.fastq1) or "."
+    cmd_params = " ".join(["--filter", "-f", fp.pear, "-b", barcodes_file, "-c", fp.chimera, "-q", str(min_quality_score), "-s", demux_summary, "-d", demux_dir])
+
+    run_command('demultiplex', demux_summary, os.path.join(prog_dir, "fastq_demultiplex.py"), cmd_params, False)
+
 def run_dereplicate(output_base_file, sample_names_file):
     derep_fa = output_base_file + ".derep.fa"
     derep_counts = output_base_file + ".derep.counts"
     cmd_params = "-o " + derep_fa + " -c " + derep_counts + " -t 3"
+    if derep_parallel:
+        cmd_params += " -x " + str(cpus) + " --readers " + str(cpus)
+    if recruit_rare:
+        cmd_params += " --rare_fa " + output_base_file + ".rare.fa --rare_counts " + output_base_file + ".rare.counts"
     if len(list_seq_file_pairs) > 1:
         cmd_params += " -l 2"
     if sample_names_file:
@@ -150,6 +202,12 @@ def run_swarm(output_base_file):
     swarm_fa = output_base_file + ".swarm.fa"
     swarm_counts = output_base_file + ".swarm.counts"
     cmd_params = " ".join(["-x", str(cpus), "-f", derep_fa, "-d", derep_counts, "-s", swarm_file, "-o", swarm_fa, "-c", swarm_counts])
+    if swarm_engine == "native":
+        cmd_params += " --native"
+    elif swarm_engine == "unoise":
+        cmd_params += " --unoise"
+    if recruit_rare and os.path.exists(output_base_file + ".rare.fa"):
+        cmd_params += " -r " + output_base_file + ".rare.fa -e " + output_base_file + ".rare.counts"
     
     run_command('swarm', swarm_fa, os.path.join(prog_dir, "swarm_map.py"), cmd_params, False)
 
@@ -426,6 +484,10 @@ def init():
     global dict_database_path
     global taxa_groups_file
     global do_chimera_search
+    global chimera_engine
+    global recruit_rare
+    global derep_parallel
+    global swarm_engine
     init_file = os.path.join(prog_dir, 'init.txt')
 
     in_handle = happyfile.hopen(init_file)
@@ -457,6 +519,17 @@ def init():
                 if key == 'chimera':
                     if re.match('^(off|no)', value.lower()):
                         do_chimera_search = False
+                    elif re.match('^native', value.lower()):
+                        chimera_engine = "native"
+                if key == 'swarm':
+                    if re.match('^native', value.lower()):
+                        swarm_engine = "native"
+                    elif re.match('^(unoise|denoise|asv)', value.lower()):
+                        swarm_engine = "unoise"
+                if key == 'rare':
+                    recruit_rare = bool(re.match('^(recruit|yes|on)', value.lower()))
+                if key == 'dereplicate':
+                    derep_parallel = bool(re.match('^(parallel|yes|on)', value.lower()))
     
         in_handle.close()
 
@@ -476,8 +549,10 @@ def test_each_dependency(cmd, name):
 def test_dependencies():
     failed = 0
     failed += test_each_dependency("pear", "PEAR")
-    failed += test_each_dependency("usearch", "USEARCH")
-    failed += test_each_dependency("swarm", "SWARM")
+    if chimera_engine == "usearch":
+        failed += test_each_dependency("usearch", "USEARCH")
+    if swarm_engine == "swarm":
+        failed += test_each_dependency("swarm", "SWARM")
     failed += test_each_dependency("glsearch36", "FASTA36")
     if failed:
         print >>sys.stderr, "[rRNA_pipeline] test_dependencies: " + str(failed) + " test(s) failed"
@@ -517,6 +592,8 @@ def test_each_script(script):
 def test_scripts():
     failed = 0
     failed += test_each_script("fastq_filter.py")
+    failed += test_each_script("chimera_ref.py")
+    failed += test_each_script("fastq_demultiplex.py")
     failed += test_each_script("fasta_dereplicate.py")
     failed += test_each_script("swarm_map.py")
     failed += test_each_script("swarm_classify_taxonomy.py")
@@ -530,8 +607,8 @@ def test_scripts():
 
 def test_all():
     failed = 0
-    failed += test_dependencies()
     failed += test_databases()
+    failed += test_dependencies()
     failed += test_scripts()
     if failed:
         print >>sys.stderr, "[rRNA_pipeline] test_all: " + str(failed) + " test(s) failed"
@@ -551,6 +628,7 @@ def main(argv):
         "   -q dir           : FASTQ folder",
         "   -o file          : base filename for results (default: rrna)",
         "   -n file          : sample names file (optional)",
+        "   -b file          : barcodes file for a pooled FASTQ (sample, barcode)",
         "   -p               : calculate/plot OTU purity",
         "   -m int           : minimum quality score for FASTQ (default: 30)",
         "   -s, --steps list : run only the steps in list (default: All)",
@@ -576,6 +654,7 @@ def main(argv):
     database_file = ""
     fastq_dir = ""
     sample_names_file = ""
+    barcodes_file = ""
     calc_purity = False
     output_base_file = "rrna"
     min_quality_score = 30
@@ -585,7 +664,7 @@ def main(argv):
     dict_steps = {}
     
     try:
-        opts, args = getopt.getopt(argv[1:], "d:q:o:n:pm:s:t:Wwhv", ["steps", "overwrite", "cpus=", "help", "verbose", "test"])
+        opts, args = getopt.getopt(argv[1:], "d:q:o:n:b:pm:s:t:Wwhv", ["steps", "overwrite", "cpus=", "help", "verbose", "test"])
     except getopt.GetoptError:
         print >>sys.stderr, help
         sys.exit(2)
@@ -605,6 +684,8 @@ def main(argv):
             output_base_file = arg
         elif opt == '-n':
             sample_names_file = arg
+        elif opt == '-b':
+            barcodes_file = arg
         elif opt == '-p':
             calc_purity = True
         elif opt == '-m':
@@ -654,11 +735,15 @@ def main(argv):
         print >>sys.stderr, "\n".join([
             "input fastq dir:    " + fastq_dir,
             "input sample names: " + sample_names_file,
+            "input barcodes:     " + barcodes_file,
             "database name:      " + database_name,
             "database file:      " + database_file,
             "output base file:   " + output_base_file,
             "overwrite files:    " + ("no", "yes")[overwrite],
-            "chimera search:     " + ("no", "yes")[do_chimera_search],
+            "chimera search:     " + ("no", chimera_engine)[do_chimera_search],
+            "recruit rare:       " + ("no", "yes")[recruit_rare],
+            "dereplicate:        " + ("serial", "parallel")[derep_parallel],
+            "swarm engine:       " + swarm_engine,
             "min fastq quality:  " + str(min_quality_score),
             "cpus:               " + str(cpus)])
 
@@ -668,6 +753,10 @@ def main(argv):
     if fastq_dir:
         get_seq_file_pairs(fastq_dir)
 
+        if barcodes_file and len(list_seq_file_pairs) != 1:
+            print >>sys.stderr, "[rRNA_pipeline] ERROR: barcodes file (-b) requires exactly one pooled FASTQ in: " + fastq_dir
+            sys.exit(2)
+
         print >>sys.stderr, "Found " + str(len(list_seq_file_pairs)) + " samples"
         for fp in sorted(list_seq_file_pairs, key=lambda fp: fp.basefile):
             print >>sys.stderr, fp.basefile + " " + ("", " [paired]")[fp.ispaired]
@@ -678,7 +767,15 @@ def main(argv):
             if run_all_steps or 'chimera' in dict_steps:
                 run_usearch(fp, database_file)
             if run_all_steps or 'filter_fasta' in dict_steps:
-                run_filter(fp, min_quality_score)
+                if barcodes_file:
+                    run_demultiplex(fp, barcodes_file, min_quality_score)
+                else:
+                    run_filter(fp, min_quality_score)
+
+        if barcodes_file:
+            get_demux_file_pairs(barcodes_file, fastq_dir)
+            if not sample_names_file:
+                sample_names_file = write_demux_names(output_base_file)
     else:
         print >>sys.stderr, "[rRNA_pipeline] skipping FASTQ merge/chimera/filtering"
     
@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+#
+# chimera_ref - reference-based chimera detection with a persistent k-mer index (uchimeout format)
+#
+# Version: 0.4 (5/21/2016)
+#
+# Part of rRNA_pipeline - FASTQ filtering, and swarm OTU classification of 16/18S barcodes
+#
+# Original version: 4/11/2016 John P. McCrow (jmccrow [at] jcvi.org)
+# J. Craig Venter Institute (JCVI)
+# La Jolla, CA USA
+#
+# The reference database is indexed once into a binary k-mer index (database + ".kmerK"),
+# which is rebuilt only when missing or older than the database, and is memory-mapped by
+# each worker process so that the page cache is shared between them.
+#
+# Each query is scored against its best candidate parents as a two-segment model over
+# query k-mer positions.  Positions where the two parents disagree vote for (Y) or against (N)
+# the chimeric model, and positions matching neither parent abstain (A), as in uchime:
+#   score = Y / (8 * (N + 1.4) + A)
+# A query is chimeric (Y) when score >= 0.28, the chimeric model improves identity over the
+# top single parent by at least 0.8%, and each segment has at least 3 supporting k-mers.
+#
+import sys, re, os, getopt
+import struct, array, mmap
+import multiprocessing
+from collections import Counter
+import happyfile
+
+verbose = False
+
+index_magic = b'RRKMER01'
+index_header_format = '=8s6I'
+dict_base_code = {'a' : 0, 'c' : 1, 'g' : 2, 't' : 3, 'A' : 0, 'C' : 1, 'G' : 2, 'T' : 3}
+
+min_score = 0.28
+min_divergence = 0.8
+min_diffs = 3
+max_candidates = 3
+batch_size = 1000
+
+kmer_index = None
+
+def to_str(s):
+    if isinstance(s, str):
+        return s
+    return s.decode()
+
+def kmer_codes(seq, k):
+    # 2-bit encoded k-mer at each query position, -1 where the k-mer contains a non-ACGT base
+    mask = (1 << (2 * k)) - 1
+    codes = []
+    code = 0
+    valid = 0
+    for i in range(len(seq)):
+        v = dict_base_code.get(seq[i], -1)
+        if v < 0:
+            code = 0
+            valid = 0
+        else:
+            code = ((code << 2) | v) & mask
+            valid += 1
+        if i >= k - 1:
+            if valid >= k:
+                codes.append(code)
+            else:
+                codes.append(-1)
+    return codes
+
+class KmerIndex:
+    def __init__(self, index_file):
+        self.handle = open(index_file, 'rb')
+        self.mm = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        header_size = struct.calcsize(index_header_format)
+        magic, self.k, self.num_refs, num_postings, seq_arena_len, label_arena_len, reserved = struct.unpack_from(index_header_format, self.mm, 0)
+        if magic != index_magic:
+            raise ValueError("not a k-mer index: " + index_file)
+        self.max_postings = max(64, self.num_refs // 8)
+        num_kmers = 1 << (2 * self.k)
+        self.kmer_offsets_pos = header_size
+        self.postings_pos = self.kmer_offsets_pos + 4 * (num_kmers + 1)
+        self.seq_offsets_pos = self.postings_pos + 4 * num_postings
+        self.label_offsets_pos = self.seq_offsets_pos + 4 * (self.num_refs + 1)
+        self.seq_arena_pos = self.label_offsets_pos + 4 * (self.num_refs + 1)
+        self.label_arena_pos = self.seq_arena_pos + seq_arena_len
+
+    def _range(self, table_pos, i):
+        return struct.unpack_from('=2I', self.mm, table_pos + 4 * i)
+
+    def postings(self, code):
+        start, end = self._range(self.kmer_offsets_pos, code)
+        return array.array('I', self.mm[self.postings_pos + 4 * start : self.postings_pos + 4 * end])
+
+    def num_postings(self, code):
+        start, end = self._range(self.kmer_offsets_pos, code)
+        return end - start
+
+    def ref_seq(self, i):
+        start, end = self._range(self.seq_offsets_pos, i)
+        return to_str(self.mm[self.seq_arena_pos + start : self.seq_arena_pos + end])
+
+    def ref_label(self, i):
+        start, end = self._range(self.label_offsets_pos, i)
+        return to_str(self.mm[self.label_arena_pos + start : self.label_arena_pos + end])
+
+    def close(self):
+        self.mm.close()
+        self.handle.close()
+
+def read_fasta_seqs(fasta_file):
+    in_handle = happyfile.hopen_or_else(fasta_file)
+
+    id = ""
+    seq = ""
+    while 1:
+        line = in_handle.readline()
+        if not line:
+            break
+        line = to_str(line).rstrip()
+
+        if line.startswith(">"):
+            if seq:
+                yield id, seq
+            id = re.split('\s', line[1:])[0]
+            seq = ""
+        else:
+            seq += re.sub('\s', '', line).lower()
+    if seq:
+        yield id, seq
+    in_handle.close()
+
+def build_index(database_file, index_file, k):
+    seq_arena = bytearray()
+    label_arena = bytearray()
+    seq_offsets = array.array('I', [0])
+    label_offsets = array.array('I', [0])
+    kmer_counts = array.array('I', [0]) * (1 << (2 * k))
+
+    if verbose:
+        print("Building k-mer index: " + index_file, file=sys.stderr)
+
+    for id, seq in read_fasta_seqs(database_file):
+        seq_arena.extend(seq.encode())
+        label_arena.extend(id.encode())
+        seq_offsets.append(len(seq_arena))
+        label_offsets.append(len(label_arena))
+        for code in set(kmer_codes(seq, k)):
+            if code >= 0:
+                kmer_counts[code] += 1
+
+    num_refs = len(seq_offsets) - 1
+    kmer_offsets = array.array('I', [0]) * (len(kmer_counts) + 1)
+    for code in range(len(kmer_counts)):
+        kmer_offsets[code+1] = kmer_offsets[code] + kmer_counts[code]
+
+    postings = array.array('I', [0]) * kmer_offsets[-1]
+    fill = kmer_offsets[:-1]
+    for i in range(num_refs):
+        seq = to_str(bytes(seq_arena[seq_offsets[i]:seq_offsets[i+1]]))
+        for code in set(kmer_codes(seq, k)):
+            if code >= 0:
+                postings[fill[code]] = i
+                fill[code] += 1
+
+    tmp_file = index_file + ".tmp" + str(os.getpid())
+    out_handle = open(tmp_file, 'wb')
+    out_handle.write(struct.pack(index_header_format, index_magic, k, num_refs, len(postings), len(seq_arena), len(label_arena), 0))
+    kmer_offsets.tofile(out_handle)
+    postings.tofile(out_handle)
+    seq_offsets.tofile(out_handle)
+    label_offsets.tofile(out_handle)
+    out_handle.write(bytes(seq_arena))
+    out_handle.write(bytes(label_arena))
+    out_handle.close()
+    os.rename(tmp_file, index_file)
+
+    if verbose:
+        print("Indexed references: " + str(num_refs) + " k-mer postings: " + str(len(postings)), file=sys.stderr)
+
+def index_is_current(database_file, index_file, k):
+    if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(database_file):
+        return False
+    in_handle = open(index_file, 'rb')
+    header = in_handle.read(struct.calcsize(index_header_format))
+    in_handle.close()
+    if len(header) < struct.calcsize(index_header_format):
+        return False
+    magic, index_k = struct.unpack(index_header_format, header)[:2]
+    return magic == index_magic and index_k == k
+
+def get_index(database_file, index_file, k):
+    if not index_file:
+        index_file = database_file + ".kmer" + str(k)
+    if not index_is_current(database_file, index_file, k):
+        build_index(database_file, index_file, k)
+    elif verbose:
+        print("Using k-mer index: " + index_file, file=sys.stderr)
+    return index_file
+
+def top_candidates(index, codes):
+    half = len(codes) // 2
+    left_counts = Counter()
+    right_counts = Counter()
+    for j in range(len(codes)):
+        code = codes[j]
+        if code >= 0 and index.num_postings(code) <= index.max_postings:
+            if j < half:
+                left_counts.update(index.postings(code))
+            else:
+                right_counts.update(index.postings(code))
+
+    # best parents for each half, plus the best whole-query hits among the leading ones
+    candidates = []
+    leading = {}
+    for counts in (left_counts, right_counts):
+        for ref, count in counts.most_common(4 * max_candidates):
+            leading[ref] = left_counts[ref] + right_counts[ref]
+        for ref, count in counts.most_common(max_candidates):
+            if not ref in candidates:
+                candidates.append(ref)
+    for ref in sorted(leading, key=leading.get, reverse=True)[:max_candidates]:
+        if not ref in candidates:
+            candidates.append(ref)
+    return candidates
+
+def popcount(x):
+    return bin(x).count('1')
+
+def percent(count, n):
+    return "%.1f" % (100.0 * count / n)
+
+def score_query(index, id, seq):
+    codes = kmer_codes(seq.lower(), index.k)
+    n = len(codes)
+    no_hit = "\t".join(["0.0000", id] + ["*"] * 14 + ["N"])
+    if n < 2:
+        return no_hit
+
+    candidates = top_candidates(index, codes)
+    if not candidates:
+        return no_hit
+
+    # per-candidate match mask and prefix match counts over query k-mer positions
+    dict_mask = {}
+    dict_prefix = {}
+    for ref in candidates:
+        ref_codes = set(kmer_codes(index.ref_seq(ref), index.k))
+        mask = 0
+        prefix = [0]
+        for j in range(n):
+            if codes[j] >= 0 and codes[j] in ref_codes:
+                mask |= 1 << j
+                prefix.append(prefix[-1] + 1)
+            else:
+                prefix.append(prefix[-1])
+        dict_mask[ref] = mask
+        dict_prefix[ref] = prefix
+
+    top = max(candidates, key=lambda ref: dict_prefix[ref][n])
+    top_matches = dict_prefix[top][n]
+
+    best_matches = -1
+    best = None
+    for a in candidates:
+        prefix_a = dict_prefix[a]
+        for b in candidates:
+            if a == b:
+                continue
+            prefix_b = dict_prefix[b]
+            total_b = prefix_b[n]
+            for x in range(1, n):
+                matches = prefix_a[x] + total_b - prefix_b[x]
+                if matches > best_matches:
+                    best_matches = matches
+                    best = (a, b, x)
+
+    if best is None:
+        return no_hit
+
+    a, b, x = best
+    mask_a = dict_mask[a]
+    mask_b = dict_mask[b]
+    left = (1 << x) - 1
+    right = ((1 << n) - 1) ^ left
+    neither = ~(mask_a | mask_b)
+    ly = popcount(mask_a & ~mask_b & left)
+    ln = popcount(mask_b & ~mask_a & left)
+    la = popcount(neither & left)
+    ry = popcount(mask_b & ~mask_a & right)
+    rn = popcount(mask_a & ~mask_b & right)
+    ra = popcount(neither & right)
+
+    score = (ly + ry) / (8.0 * (ln + rn + 1.4) + la + ra)
+    divergence = 100.0 * (best_matches - top_matches) / n
+    same_ab = n - popcount(mask_a ^ mask_b)
+    is_chimera = score >= min_score and divergence >= min_divergence and ly >= min_diffs and ry >= min_diffs
+
+    return "\t".join(["%.4f" % score, id, index.ref_label(a), index.ref_label(b),
+        percent(best_matches, n), percent(dict_prefix[a][n], n), percent(dict_prefix[b][n], n), percent(same_ab, n), percent(top_matches, n),
+        str(ly), str(ln), str(la), str(ry), str(rn), str(ra), "%.1f" % divergence, ("N", "Y")[is_chimera]])
+
+def init_worker(index_file):
+    global kmer_index
+    kmer_index = KmerIndex(index_file)
+
+def score_batch(batch):
+    return [score_query(kmer_index, id, seq) for id, seq in batch]
+
+def read_query_batches(query_file):
+    in_handle = happyfile.hopen_or_else(query_file)
+
+    batch = []
+    id = ""
+    seq = ""
+    rnum = 0
+    is_fastq = None
+    while 1:
+        line = in_handle.readline()
+        if not line:
+            break
+        line = to_str(line).rstrip()
+
+        if is_fastq is None:
+            is_fastq = line.startswith("@")
+
+        if is_fastq:
+            rnum += 1
+            if rnum == 1:
+                id = re.split('\s', line[1:])[0]
+            elif rnum == 2:
+                batch.append((id, line))
+            elif rnum == 4:
+                rnum = 0
+        elif line.startswith(">"):
+            if id:
+                batch.append((id, seq))
+            id = re.split('\s', line[1:])[0]
+            seq = ""
+        else:
+            seq += re.sub('\s', '', line)
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if not is_fastq and id:
+        batch.append((id, seq))
+    if batch:
+        yield batch
+    in_handle.close()
+
+def find_chimeras(query_file, index_file, output_file, cpus):
+    out_handle = sys.stdout
+    if output_file:
+        out_handle = happyfile.hopen_write_or_else(output_file)
+
+    if verbose:
+        print("Reading query file: " + query_file, file=sys.stderr)
+        if output_file:
+            print("Writing uchimeout file: " + output_file, file=sys.stderr)
+
+    count_queries = 0
+    count_chimeras = 0
+    if cpus > 1:
+        pool = multiprocessing.Pool(cpus, init_worker, (index_file,))
+        results = pool.imap(score_batch, read_query_batches(query_file))
+    else:
+        pool = None
+        init_worker(index_file)
+        results = (score_batch(batch) for batch in read_query_batches(query_file))
+
+    for rows in results:
+        for row in rows:
+            count_queries += 1
+            if row.endswith("\tY"):
+                count_chimeras += 1
+            print(row, file=out_handle)
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    if output_file:
+        out_handle.close()
+
+    if verbose and count_queries:
+        print("queries: " + str(count_queries) + " chimeras: " + str(count_chimeras) + " (" + str(round(100.0*count_chimeras/count_queries, 1)) + "%)", file=sys.stderr)
+
+def test_chimera():
+    global kmer_index
+    retval = True
+    parent_a = "acgtcatgcatctagctactacgagcacgatcatcgtagcttgacgatcgatcgggatcgatcatcagct"
+    parent_b = "tgcatgcatcgatcgtagctagctaatcgatcgtagctagcttagcagctagctggcatcgatcgatgca"
+    chimera = parent_a[:35] + parent_b[35:]
+    database_file = "test_chimera_ref.fa"
+    index_file = database_file + ".kmer8"
+
+    out_handle = open(database_file, 'w')
+    out_handle.write(">parentA\n" + parent_a + "\n>parentB\n" + parent_b + "\n")
+    out_handle.close()
+
+    get_index(database_file, index_file, 8)
+    kmer_index = KmerIndex(index_file)
+    cols_chimera = score_query(kmer_index, "query1", chimera).split("\t")
+    cols_parent = score_query(kmer_index, "query2", parent_a).split("\t")
+    kmer_index.close()
+    os.remove(database_file)
+    os.remove(index_file)
+
+    if len(cols_chimera) == 17 and cols_chimera[16] == 'Y' and cols_chimera[1] == "query1" and cols_parent[16] == 'N':
+        print("[chimera_ref] test_chimera: passed", file=sys.stderr)
+    else:
+        print("[chimera_ref] test_chimera: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_all():
+    if not test_chimera():
+        sys.exit(2)
+
+###
+
+def main(argv):
+    help = "\n".join([
+        "chimera_ref v0.4 (May 21, 2016)",
+        "Reference-based chimera detection (uchimeout format)",
+        "",
+        "Usage: " + os.path.basename(argv[0]) + " (options)",
+        "   -f file        : query FASTQ or FASTA file (required)",
+        "   -d file        : reference database FASTA file (required)",
+        "   -o file        : output uchimeout file (default: stdout)",
+        "   -i file        : k-mer index file (default: database.kmerK)",
+        "   -k int         : k-mer length (default: 8)",
+        "   -t, --cpus int : number of processes (default: 1)",
+        "   -h, --help     : help",
+        "   -v, --verbose  : more information to stderr", ""])
+
+    global verbose
+    query_file = ""
+    database_file = ""
+    output_file = ""
+    index_file = ""
+    k = 8
+    cpus = 1
+
+    try:
+        opts, args = getopt.getopt(argv[1:], "f:d:o:i:k:t:hv", ["cpus=", "help", "verbose", "test"])
+    except getopt.GetoptError:
+        print(help, file=sys.stderr)
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print(help, file=sys.stderr)
+            sys.exit()
+        elif opt == '--test':
+            test_all()
+            sys.exit()
+        elif opt == '-f':
+            query_file = arg
+        elif opt == '-d':
+            database_file = arg
+        elif opt == '-o':
+            output_file = arg
+        elif opt == '-i':
+            index_file = arg
+        elif opt == '-k':
+            k = int(re.sub('=','', arg))
+        elif opt in ("-t", "--cpus"):
+            cpus = int(re.sub('=','', arg))
+        elif opt in ("-v", "--verbose"):
+            verbose = True
+
+    if not (query_file and database_file):
+        print(help, file=sys.stderr)
+        sys.exit(2)
+
+    if k < 4 or k > 15:
+        print(help + "\nk-mer length must be 4-15", file=sys.stderr)
+        sys.exit(2)
+
+    if verbose:
+        print("\n".join([
+            "query file:     " + query_file,
+            "database file:  " + database_file,
+            "index file:     " + index_file,
+            "output file:    " + output_file,
+            "k-mer length:   " + str(k),
+            "cpus:           " + str(cpus)]), file=sys.stderr)
+
+    index_file = get_index(database_file, index_file, k)
+    find_chimeras(query_file, index_file, output_file, cpus)
+
+if __name__ == "__main__":
+    main(sys.argv)
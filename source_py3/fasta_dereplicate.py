@@ -11,18 +11,50 @@
 # La Jolla, CA USA
 #
 import sys, re, os, getopt
-import gzip, bz2
+import gzip, bz2, tempfile, shutil
+import multiprocessing, multiprocessing.pool
+try:
+    import queue as thread_queue
+except ImportError:
+    import Queue as thread_queue
 import happyfile
-import hashlib
+import happymatrix
+import happysort
+import happyarena
+import hashlib, heapq
 
 verbose = False
 
 dict_all_sample_names = {}
 dict_sample_name = {}
-dict_id_file_counts = {}
-dict_id_counts = {}
-dict_id_seq = {}
-dict_id_map = {}
+dict_file_counts = {}
+list_file_ids = []
+seq_arena = happyarena.SeqArena()
+dict_bestid = {}
+keep_bestid = False
+map_run_file = ""
+map_run_handle = None
+batch_size = 10000
+readers = 1
+read_ahead = 4
+counts_coo = happymatrix.CountsCOO()
+max_memory = 0
+memory_used = 0
+unique_overhead = 32
+count_overhead = 20
+list_spill_runs = []
+spill_dir = ""
+sketch_depth = 4
+sketch_width = 0
+sketch_counts = None
+sketch_samples = None
+sketch_last_file = None
+sketch_min_count = 1
+sketch_min_samples = 1
+list_store_samples = []
+rare_fasta_file = ""
+rare_counts_file = ""
+store_next_column = 0
 good_fasta_files = []
 
 class Format:
@@ -60,66 +92,590 @@ def read_sample_names(sample_names_file):
 
         in_handle.close()
 
-def derep_line(id, seq, filenum):
-    global dict_id_file_counts
-    global dict_id_counts
-    global dict_id_seq
+def derep_id(key):
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def derep_line(id, seq):
+    global dict_file_counts
+    global list_file_ids
     
     if seq:
+        # reads are staged per file, keyed on the sequence itself
         seq = seq.lower()
-        key = hashlib.sha1(seq.encode()).hexdigest()
-        dict_id_counts[key] = dict_id_counts.get(key,0) + 1
-        dict_id_file_counts[key, filenum] = dict_id_file_counts.get((key, filenum), 0) + 1
-        dict_id_seq[key] = seq
-        dict_id_map[id] = key
+        dict_file_counts[seq] = dict_file_counts.get(seq, 0) + 1
+        if keep_bestid or map_run_handle:
+            list_file_ids.append((id, seq))
+
+def open_map_run(output_map_file):
+    global map_run_file
+    global map_run_handle
+
+    # (unique index, read id) pairs are streamed to disk, and sorted by index only when the map is written
+    fd, map_run_file = tempfile.mkstemp(prefix=os.path.basename(output_map_file) + ".", suffix=".run", dir=os.path.dirname(os.path.abspath(output_map_file)))
+    map_run_handle = os.fdopen(fd, 'w')
+
+def map_run_index(line):
+    return int(line[:line.index("\t")])
+
+def map_run_seq(line):
+    return line[:line.index("\t")]
+
+def merge_file(filenum):
+    global dict_bestid
+    global memory_used
+
+    # uniques get a global index, and counts a sample column, only once a file is accepted
+    first_new_index = len(seq_arena)
+    dict_file_index = {}
+    for seq in dict_file_counts:
+        index, is_new = seq_arena.add(seq)
+        if is_new:
+            memory_used += len(seq) + unique_overhead
+        dict_file_index[seq] = index
+        counts_coo.append(index, filenum, dict_file_counts[seq])
+        memory_used += count_overhead
+
+    for id, seq in list_file_ids:
+        index = dict_file_index[seq]
+        if keep_bestid and index >= first_new_index and not index in dict_bestid:
+            dict_bestid[index] = id
+        if map_run_handle:
+            # unique indexes restart after each spill, so spilled map runs are keyed on the sequence
+            if max_memory:
+                map_run_handle.write(seq + "\t" + id + "\n")
+            else:
+                map_run_handle.write(str(index) + "\t" + id + "\n")
+
+    if max_memory and memory_used > max_memory:
+        spill_run(filenum + 1)
+
+def spill_run(num_files):
+    global seq_arena
+    global dict_bestid
+    global counts_coo
+    global memory_used
+
+    # uniques sorted by sequence, with sparse sample counts (filenum:count,...) and best ID
+    counts_matrix = happymatrix.coo_to_csr(counts_coo, len(seq_arena), num_files)
+    lines = []
+    for index in range(len(seq_arena)):
+        cells = ",".join(str(filenum) + ":" + str(count) for filenum, count in counts_matrix.row_items(index))
+        lines.append(seq_arena[index] + "\t" + cells + "\t" + dict_bestid.get(index, "") + "\n")
+    lines.sort()
+    list_spill_runs.append(happysort.write_run(lines, spill_dir))
+
+    if verbose:
+        print("Spilled uniques to disk: " + str(len(lines)), file=sys.stderr)
+
+    seq_arena = happyarena.SeqArena()
+    dict_bestid = {}
+    counts_coo = happymatrix.CountsCOO()
+    memory_used = 0
+
+def read_spill_run(run_file, run_num):
+    in_handle = open(run_file)
+    for line in in_handle:
+        seq, cells, bestid = line.rstrip("\n").split("\t", 2)
+        yield seq, run_num, cells, bestid
+    in_handle.close()
+    os.remove(run_file)
+
+def merge_spill_runs(num_files):
+    # k-way merge of spilled runs; the same sequence from several runs is combined
+    runs = [read_spill_run(list_spill_runs[i], i) for i in range(len(list_spill_runs))]
+    last_seq = None
+    for seq, run_num, cells, bestid in heapq.merge(*runs):
+        if seq != last_seq:
+            if last_seq is not None:
+                yield last_seq, samplecounts, last_bestid
+            last_seq = seq
+            last_bestid = bestid
+            samplecounts = [0] * num_files
+        for cell in cells.split(","):
+            if cell:
+                filenum, count = cell.split(":")
+                samplecounts[int(filenum)] += int(count)
+    if last_seq is not None:
+        yield last_seq, samplecounts, last_bestid
+
+def read_fasta_records(fasta_file):
+    in_handle = happyfile.hopen_or_else(fasta_file)
+    
+    if verbose:
+        print("Reading FASTA file: " + fasta_file, file=sys.stderr)
+
+    id = ""
+    seq = ""
+    firstrecord = True
+    while 1:
+        line = in_handle.readline()
+        if not line:
+            break
+        line = line.rstrip()
+
+        if line.startswith(">"):
+            if not firstrecord:
+                yield id, seq
+            firstrecord = False
+            id = line[1:]
+            seq = ""
+        else:
+            seq += re.sub('\s', '', line)
+    if not firstrecord:
+        yield id, seq
+    in_handle.close()
+
+def read_store(store_dir):
+    global store_next_column
+
+    # store: samples.txt (column, fasta file), uniques.txt (one sequence per unique index),
+    # and per sample <column>.counts (index, count, first read id) and <column>.map (index, read id)
+    samples_file = os.path.join(store_dir, "samples.txt")
+    if os.path.exists(samples_file):
+        if verbose:
+            print("Reading dereplication store: " + store_dir, file=sys.stderr)
+
+        in_handle = happyfile.hopen_or_else(samples_file)
+        for line in in_handle:
+            column, fasta_file = line.rstrip("\n").split("\t")
+            list_store_samples.append((column, fasta_file))
+            store_next_column = max(store_next_column, int(column[6:]) + 1)
+        in_handle.close()
+
+    uniques_file = os.path.join(store_dir, "uniques.txt")
+    if os.path.exists(uniques_file):
+        in_handle = happyfile.hopen_or_else(uniques_file)
+        for line in in_handle:
+            seq_arena.append(line.rstrip("\n"))
+        in_handle.close()
+
+def write_store_samples(store_dir):
+    samples_file = os.path.join(store_dir, "samples.txt")
+    out_handle = happyfile.hopen_write_or_else(samples_file + ".tmp")
+    for column, fasta_file in list_store_samples:
+        print(column + "\t" + fasta_file, file=out_handle)
+    out_handle.close()
+    os.rename(samples_file + ".tmp", samples_file)
+
+def remove_store_sample(store_dir, fasta_file):
+    for column, file in list_store_samples:
+        if file == fasta_file:
+            list_store_samples.remove((column, file))
+            os.remove(os.path.join(store_dir, column + ".counts"))
+            os.remove(os.path.join(store_dir, column + ".map"))
+            return True
+    return False
+
+def rewrite_store_indices(store_file, new_index):
+    in_handle = happyfile.hopen_or_else(store_file)
+    out_handle = happyfile.hopen_write_or_else(store_file + ".tmp")
+    for line in in_handle:
+        index, rest = line.split("\t", 1)
+        out_handle.write(str(new_index[int(index)]) + "\t" + rest)
+    in_handle.close()
+    out_handle.close()
+    os.rename(store_file + ".tmp", store_file)
+
+def compact_store(store_dir):
+    global seq_arena
+
+    # uniques left without counts by removed samples are dropped, and the rest renumbered in order
+    used = bytearray(len(seq_arena))
+    for column, fasta_file in list_store_samples:
+        in_handle = happyfile.hopen_or_else(os.path.join(store_dir, column + ".counts"))
+        for line in in_handle:
+            used[int(line.split("\t", 1)[0])] = 1
+        in_handle.close()
+
+    num_used = sum(used)
+    if num_used == len(seq_arena):
+        return
+
+    if verbose:
+        print("Removing uniques from store: " + str(len(seq_arena) - num_used), file=sys.stderr)
+
+    new_index = happymatrix.int64_array(len(seq_arena))
+    new_arena = happyarena.SeqArena()
+    uniques_file = os.path.join(store_dir, "uniques.txt")
+    out_handle = happyfile.hopen_write_or_else(uniques_file + ".tmp")
+    for index in range(len(seq_arena)):
+        if used[index]:
+            seq = seq_arena[index]
+            new_index[index] = new_arena.append(seq)
+            out_handle.write(seq + "\n")
+    out_handle.close()
+    os.rename(uniques_file + ".tmp", uniques_file)
+    seq_arena = new_arena
+
+    for column, fasta_file in list_store_samples:
+        rewrite_store_indices(os.path.join(store_dir, column + ".counts"), new_index)
+        rewrite_store_indices(os.path.join(store_dir, column + ".map"), new_index)
+
+def add_store_file(store_dir, fasta_file, records, min_fasta):
+    global dict_file_counts
+    global list_file_ids
+    global store_next_column
+    total_seqs = 0
+    dict_file_counts = {}
+    list_file_ids = []
+
+    for id, seq in records:
+        total_seqs += 1
+        derep_line(id, seq)
+
+    # a file added again replaces its earlier counts
+    remove_store_sample(store_dir, fasta_file)
+
+    if total_seqs < min_fasta:
+        print("[fasta_dereplicate] Excluding: " + fasta_file, file=sys.stderr)
+    else:
+        column = "sample" + str(store_next_column)
+        store_next_column += 1
+
+        uniques_handle = open(os.path.join(store_dir, "uniques.txt"), 'a')
+        counts_handle = happyfile.hopen_write_or_else(os.path.join(store_dir, column + ".counts"))
+        map_handle = happyfile.hopen_write_or_else(os.path.join(store_dir, column + ".map"))
+        dict_file_index = {}
+        for id, seq in list_file_ids:
+            if not seq in dict_file_index:
+                index, is_new = seq_arena.add(seq)
+                if is_new:
+                    uniques_handle.write(seq + "\n")
+                dict_file_index[seq] = index
+            index = dict_file_index[seq]
+            if seq in dict_file_counts:
+                counts_handle.write(str(index) + "\t" + str(dict_file_counts.pop(seq)) + "\t" + id + "\n")
+            map_handle.write(str(index) + "\t" + id + "\n")
+        uniques_handle.close()
+        counts_handle.close()
+        map_handle.close()
+
+        list_store_samples.append((column, fasta_file))
+
+    dict_file_counts = {}
+    list_file_ids = []
+
+def load_store_counts(store_dir):
+    # only the sparse per-sample columns are read back, never the reads
+    for filenum in range(len(list_store_samples)):
+        column, fasta_file = list_store_samples[filenum]
+        good_fasta_files.append(fasta_file)
+
+        in_handle = happyfile.hopen_or_else(os.path.join(store_dir, column + ".counts"))
+        for line in in_handle:
+            index, count, id = line.rstrip("\n").split("\t", 2)
+            index = int(index)
+            counts_coo.append(index, filenum, int(count))
+            if not index in dict_bestid:
+                dict_bestid[index] = id
+        in_handle.close()
+
+        if map_run_handle:
+            in_handle = happyfile.hopen_or_else(os.path.join(store_dir, column + ".map"))
+            shutil.copyfileobj(in_handle, map_run_handle)
+            in_handle.close()
+
+def sketch_cells(seq):
+    # one cell per row, from two halves of a single hash (Kirsch-Mitzenmacher)
+    h = hash(seq)
+    h1 = h & 0xffffffff
+    h2 = ((h >> 32) & 0xffffffff) | 1
+    return [i * sketch_width + (h1 + i * h2) % sketch_width for i in range(sketch_depth)]
+
+def build_sketch(fasta_files, sketch_bytes, min_samples, min_count):
+    global sketch_width
+    global sketch_counts
+    global sketch_samples
+    global sketch_last_file
+    global sketch_min_count
+    global sketch_min_samples
+
+    # count-min sketch of total counts and of samples per sequence, both upper bounds;
+    # a cell counts a sample once, the first time any sequence in that file reaches it
+    sketch_width = max(1, sketch_bytes // (16 * sketch_depth))
+    sketch_counts = happymatrix.int64_array(sketch_width * sketch_depth)
+    sketch_samples = happymatrix.int32_array(sketch_width * sketch_depth)
+    sketch_last_file = happymatrix.int32_array(sketch_width * sketch_depth)
+    sketch_min_count = min_count
+    sketch_min_samples = min_samples
+
+    filenum = 0
+    for fasta_file, records in read_fasta_files(fasta_files):
+        for id, seq in records:
+            if seq:
+                for cell in sketch_cells(seq.lower()):
+                    sketch_counts[cell] += 1
+                    if sketch_last_file[cell] != filenum + 1:
+                        sketch_last_file[cell] = filenum + 1
+                        sketch_samples[cell] += 1
+        filenum += 1
+
+    sketch_last_file = None
+
+def sketch_keep(seq):
+    # sequences that cannot reach the output thresholds are never staged
+    if sketch_counts is None:
+        return True
+    cells = sketch_cells(seq.lower())
+    return min(sketch_counts[cell] for cell in cells) >= sketch_min_count and min(sketch_samples[cell] for cell in cells) >= sketch_min_samples
+
+def read_fasta_batches(fasta_file, batch_queue):
+    try:
+        batch = []
+        for record in read_fasta_records(fasta_file):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                batch_queue.put(batch)
+                batch = []
+        batch_queue.put(batch)
+        batch_queue.put(None)
+    except BaseException:
+        # hopen_or_else exits on unreadable files; the consumer exits in its place
+        batch_queue.put(False)
+
+def read_fasta_files(fasta_files):
+    # yields (fasta_file, records) in sample order; with readers > 1, upcoming files are read and
+    # decompressed on a thread pool, each holding at most read_ahead batches until consumed
+    if readers <= 1:
+        for fasta_file in fasta_files:
+            yield fasta_file, read_fasta_records(fasta_file)
+        return
+
+    pool = multiprocessing.pool.ThreadPool(readers)
+    list_queues = []
+    for fasta_file in fasta_files:
+        batch_queue = thread_queue.Queue(read_ahead)
+        pool.apply_async(read_fasta_batches, (fasta_file, batch_queue))
+        list_queues.append(batch_queue)
+    pool.close()
+
+    for i in range(len(fasta_files)):
+        yield fasta_files[i], queued_records(list_queues[i])
+        list_queues[i] = None
+    pool.join()
+
+def queued_records(batch_queue):
+    while 1:
+        batch = batch_queue.get()
+        if batch is None:
+            break
+        if batch is False:
+            sys.exit(2)
+        for record in batch:
+            yield record
 
 def derep_fasta(fasta_files, min_fasta):
     global good_fasta_files
+    global dict_file_counts
+    global list_file_ids
     filenum = 0
     
-    for fasta_file in fasta_files:
+    for fasta_file, records in read_fasta_files(fasta_files):
         total_seqs = 0
-        in_handle = happyfile.hopen_or_else(fasta_file)
+        dict_file_counts = {}
+        list_file_ids = []
         
-        if verbose:
-            print("Reading FASTA file: " + fasta_file, file=sys.stderr)
-
-        id = ""
-        seq = ""
-        while 1:
-            line = in_handle.readline()
-            if not line:
-                break
-            line = line.rstrip()
-
-            if line.startswith(">"):
-                total_seqs += 1
-                derep_line(id, seq, filenum)
-                id = line[1:]
-                seq = ""
-            else:
-                seq += re.sub('\s', '', line)
-        derep_line(id, seq, filenum)
-        in_handle.close()
+        for id, seq in records:
+            total_seqs += 1
+            if sketch_keep(seq):
+                derep_line(id, seq)
         
-        # Remove counts for this file if below minimum
+        # Files below minimum are dropped with their staging, never touching the global tables
         if total_seqs < min_fasta:
             print("[fasta_dereplicate] Excluding: " + fasta_file, file=sys.stderr)
-            for key in dict_id_counts:
-                dict_id_counts[key] -= dict_id_file_counts.get((key, filenum), 0)
-                dict_id_file_counts[key, filenum] = 0
         else:
+            merge_file(filenum)
             good_fasta_files.append(fasta_file)
             filenum += 1
+        dict_file_counts = {}
+        list_file_ids = []
 
-def write_dereps(output_fasta_file, output_counts_file, output_map_file, id_format, min_samples, min_count):
-    dict_bestid = {}
-    dict_id_num_samples = {}
-    
-    for key in dict_id_counts:
-        for filenum in range(len(good_fasta_files)):
-            if dict_id_file_counts.get((key, filenum), 0) > 0:
-                dict_id_num_samples[key] = dict_id_num_samples.get(key, 0) + 1
+def derep_worker(queue, part_files, id_format, min_samples, min_count, settings):
+    global verbose
+    global max_memory
+    global dict_sample_name
+    global keep_bestid
+    global good_fasta_files
+    global dict_file_counts
+    global list_file_ids
+    global spill_dir
+    global rare_fasta_file
+    global rare_counts_file
+    part_fasta_file, part_counts_file, part_map_file, rare_fasta_file, rare_counts_file = part_files
+    # settings are passed explicitly, as spawned or forkserver workers do not inherit the parent's globals
+    verbose, max_memory, dict_sample_name = settings
+    filenum = 0
+
+    spill_dir = os.path.dirname(part_fasta_file)
+
+    keep_bestid = (id_format == Format.bestid)
+    if part_map_file:
+        open_map_run(part_map_file)
+
+    while 1:
+        message = queue.get()
+        if message[0] == 'reads':
+            for id, seq in message[1]:
+                derep_line(id, seq)
+        elif message[0] == 'file':
+            fasta_file, accepted = message[1:]
+            if accepted:
+                merge_file(filenum)
+                good_fasta_files.append(fasta_file)
+                filenum += 1
+            dict_file_counts = {}
+            list_file_ids = []
+        else:
+            break
+
+    write_dereps(part_fasta_file, part_counts_file, part_map_file, id_format, min_samples, min_count, False)
+
+def derep_fasta_partitioned(fasta_files, min_fasta, cpus, output_fasta_file, output_counts_file, output_map_file, id_format, min_samples, min_count):
+    global good_fasta_files
+
+    # each worker owns the uniques whose sequence hash falls in its partition
+    part_dir = tempfile.mkdtemp(prefix="fasta_dereplicate.", dir=os.path.dirname(os.path.abspath(output_fasta_file or output_counts_file or "derep")))
+    list_part_files = []
+    list_queues = []
+    list_workers = []
+    for part in range(cpus):
+        part_base = os.path.join(part_dir, "part" + str(part))
+        part_files = [part_base + ".fa", "", "", "", ""]
+        if output_counts_file:
+            part_files[1] = part_base + (".counts", ".counts.npz")[happymatrix.is_npz(output_counts_file)]
+        if output_map_file:
+            part_files[2] = part_base + ".map"
+        if rare_fasta_file:
+            part_files[3] = part_base + ".rare.fa"
+        if rare_counts_file:
+            part_files[4] = part_base + (".rare.counts", ".rare.counts.npz")[happymatrix.is_npz(rare_counts_file)]
+        queue = multiprocessing.Queue(4)
+        worker = multiprocessing.Process(target=derep_worker, args=(queue, part_files, id_format, min_samples, min_count, (verbose, max_memory, dict_sample_name)))
+        worker.start()
+        list_part_files.append(part_files)
+        list_queues.append(queue)
+        list_workers.append(worker)
+
+    for fasta_file, records in read_fasta_files(fasta_files):
+        total_seqs = 0
+        list_batches = [[] for part in range(cpus)]
+        for id, seq in records:
+            total_seqs += 1
+            if seq and sketch_keep(seq):
+                seq = seq.lower()
+                part = hash(seq) % cpus
+                list_batches[part].append((id, seq))
+                if len(list_batches[part]) >= batch_size:
+                    list_queues[part].put(('reads', list_batches[part]))
+                    list_batches[part] = []
+
+        accepted = total_seqs >= min_fasta
+        if not accepted:
+            print("[fasta_dereplicate] Excluding: " + fasta_file, file=sys.stderr)
+        else:
+            good_fasta_files.append(fasta_file)
+        for part in range(cpus):
+            if list_batches[part]:
+                list_queues[part].put(('reads', list_batches[part]))
+            list_queues[part].put(('file', fasta_file, accepted))
+
+    for part in range(cpus):
+        list_queues[part].put(('done',))
+    for worker in list_workers:
+        worker.join()
+        if worker.exitcode != 0:
+            print("[fasta_dereplicate] ERROR: worker failed", file=sys.stderr)
+            sys.exit(2)
+
+    # outputs are the concatenation of partition outputs
+    out_handle1 = sys.stdout
+    if output_fasta_file:
+        out_handle1 = happyfile.hopen_write_or_else(output_fasta_file)
+    concat_files([part_files[0] for part_files in list_part_files], out_handle1)
+    out_handle1.close()
+
+    if output_counts_file:
+        concat_counts([part_files[1] for part_files in list_part_files], output_counts_file)
+
+    if output_map_file:
+        out_handle3 = happyfile.hopen_write_or_else(output_map_file)
+        concat_files([part_files[2] for part_files in list_part_files], out_handle3)
+        out_handle3.close()
+
+    if rare_fasta_file:
+        out_handle4 = happyfile.hopen_write_or_else(rare_fasta_file)
+        concat_files([part_files[3] for part_files in list_part_files], out_handle4)
+        out_handle4.close()
+
+    if rare_counts_file:
+        concat_counts([part_files[4] for part_files in list_part_files], rare_counts_file)
+
+    shutil.rmtree(part_dir)
+
+def concat_files(part_files, out_handle):
+    for part_file in part_files:
+        in_handle = open(part_file)
+        shutil.copyfileobj(in_handle, out_handle)
+        in_handle.close()
+
+def concat_counts(part_counts_files, output_counts_file):
+    if happymatrix.is_npz(output_counts_file):
+        counts_writer = happymatrix.CountsWriter(output_counts_file, counts_column_names())
+        for part_counts_file in part_counts_files:
+            for id, fields, items in happymatrix.CountsReader(part_counts_file).rows():
+                counts_writer.write_row(id, items)
+        counts_writer.close()
+    else:
+        out_handle = happyfile.hopen_write_or_else(output_counts_file)
+        print("\t".join(['id'] + counts_column_names()), file=out_handle)
+        concat_files(part_counts_files, out_handle)
+        out_handle.close()
+
+def open_rare_outputs(counts_header=True):
+    # uniques below the output thresholds, for recruitment into OTUs by swarm_map
+    rare_handle = None
+    rare_writer = None
+    if rare_fasta_file:
+        rare_handle = happyfile.hopen_write_or_else(rare_fasta_file)
+        if verbose:
+            print("Writing rare FASTA file: " + rare_fasta_file, file=sys.stderr)
+    if rare_counts_file:
+        rare_writer = happymatrix.CountsWriter(rare_counts_file, counts_column_names(), header=counts_header)
+    return rare_handle, rare_writer
+
+def write_rare(rare_handle, rare_writer, header, seq, items):
+    if rare_handle:
+        print(">" + header + "\n" + seq, file=rare_handle)
+    if rare_writer:
+        rare_writer.write_row(re.split('\s', header)[0], items)
+
+def close_rare_outputs(rare_handle, rare_writer):
+    if rare_handle:
+        rare_handle.close()
+    if rare_writer:
+        rare_writer.close()
+
+def counts_column_names():
+    column_names = []
+    for file in good_fasta_files:
+        if file in dict_sample_name:
+            column_names.append(dict_sample_name[file])
+        elif os.path.basename(file) in dict_sample_name:
+            # sample names files list files by name, which may be given with their folder
+            column_names.append(dict_sample_name[os.path.basename(file)])
+        else:
+            column_names.append(re.sub('\.filtered\.fa$', '', file))
+    return column_names
+
+def write_dereps(output_fasta_file, output_counts_file, output_map_file, id_format, min_samples, min_count, counts_header=True):
+    if max_memory:
+        write_dereps_spilled(output_fasta_file, output_counts_file, output_map_file, id_format, min_samples, min_count, counts_header)
+        return
+
+    counts_matrix = happymatrix.coo_to_csr(counts_coo, len(seq_arena), len(good_fasta_files))
+    list_id_counts = counts_matrix.row_sums()
+    list_id_num_samples = counts_matrix.row_nnz()
+    min_count = max(min_count, 1)
 
     out_handle1 = sys.stdout
     if output_fasta_file:
@@ -128,47 +684,30 @@ def write_dereps(output_fasta_file, output_counts_file, output_map_file, id_form
     if verbose and output_fasta_file:
         print("Writing FASTA file: " + output_fasta_file, file=sys.stderr)
 
-    if id_format == Format.bestid:
-        for id in dict_id_map:
-            key = dict_id_map[id]
-            if (not key in dict_bestid) and dict_id_counts.get(key, 0) > 0:
-                dict_bestid[key] = id
-
-    for key in dict_id_counts:
-        if dict_id_num_samples.get(key, 0) >= min_samples and dict_id_counts[key] >= min_count and key in dict_id_seq:
+    for index in range(len(seq_arena)):
+        if list_id_num_samples[index] >= min_samples and list_id_counts[index] >= min_count:
+            seq = seq_arena[index]
             if id_format == Format.swarm:
-                print(">" + key + "_" + str(dict_id_counts[key]) + "\n" + dict_id_seq[key], file=out_handle1)
-            elif id_format == Format.bestid and key in dict_bestid:
-                print(">" + dict_bestid[key] + "\n" + dict_id_seq[key], file=out_handle1)
+                print(">" + derep_id(seq) + "_" + str(list_id_counts[index]) + "\n" + seq, file=out_handle1)
+            elif id_format == Format.bestid and index in dict_bestid:
+                print(">" + dict_bestid[index] + "\n" + seq, file=out_handle1)
 
     out_handle1.close()
 
     if output_counts_file:
-        out_handle2 = happyfile.hopen_write_or_else(output_counts_file)
+        counts_writer = happymatrix.CountsWriter(output_counts_file, counts_column_names(), header=counts_header)
 
         if verbose:
             print("Writing counts file: " + output_counts_file, file=sys.stderr)
 
-        column_names = ['id']
-        for file in good_fasta_files:
-            if file in dict_sample_name:
-                column_names.append(dict_sample_name[file])
-            else:
-                column_names.append(re.sub('\.filtered\.fa$', '', file))
-
-        print("\t".join(column_names), file=out_handle2)
-
-        for key in dict_id_counts:
-            if dict_id_num_samples.get(key, 0) >= min_samples and dict_id_counts[key] >= min_count:
-                samplecounts = []
-                id = key + "_" + str(dict_id_counts[key])
+        for index in range(len(seq_arena)):
+            if list_id_num_samples[index] >= min_samples and list_id_counts[index] >= min_count:
+                id = derep_id(seq_arena[index]) + "_" + str(list_id_counts[index])
                 if id_format == Format.bestid:
-                    id = re.split('\s', dict_bestid[key])[0]
-                for filenum in range(len(good_fasta_files)):
-                    samplecounts.append(dict_id_file_counts.get((key, filenum), 0))
-                print(id + "\t" + "\t".join(str(x) for x in samplecounts), file=out_handle2)
+                    id = re.split('\s', dict_bestid[index])[0]
+                counts_writer.write_row(id, counts_matrix.row_items(index))
 
-        out_handle2.close()
+        counts_writer.close()
 
     if output_map_file:
         out_handle3 = happyfile.hopen_write_or_else(output_map_file)
@@ -176,31 +715,315 @@ def write_dereps(output_fasta_file, output_counts_file, output_map_file, id_form
         if verbose:
             print("Writing map file: " + output_map_file, file=sys.stderr)
 
-        for id in sorted(dict_id_map, key=dict_id_map.get):
-            key = dict_id_map[id]
-            if dict_id_num_samples.get(key, 0) >= min_samples and dict_id_counts[key] >= min_count:
+        map_run_handle.close()
+        in_handle = open(map_run_file)
+
+        last_index = None
+        for line in happysort.sort_lines(in_handle, map_run_index, os.path.dirname(map_run_file)):
+            index, id = line.rstrip("\n").split("\t", 1)
+            index = int(index)
+            if list_id_num_samples[index] >= min_samples and list_id_counts[index] >= min_count:
+                if index != last_index:
+                    key_id = derep_id(seq_arena[index])
+                    last_index = index
                 if id_format == Format.swarm:
-                    print(key + "_" + str(dict_id_counts[key]) + "\t" + id, file=out_handle3)
+                    print(key_id + "_" + str(list_id_counts[index]) + "\t" + id, file=out_handle3)
                 elif id_format == Format.bestid:
-                    print(re.split('\s', dict_bestid[key])[0] + "\t" + id, file=out_handle3)
+                    print(re.split('\s', dict_bestid[index])[0] + "\t" + id, file=out_handle3)
 
+        in_handle.close()
+        os.remove(map_run_file)
+        out_handle3.close()
+
+    if rare_fasta_file or rare_counts_file:
+        rare_handle, rare_writer = open_rare_outputs(counts_header)
+        for index in range(len(seq_arena)):
+            if list_id_counts[index] and not (list_id_num_samples[index] >= min_samples and list_id_counts[index] >= min_count):
+                seq = seq_arena[index]
+                if id_format == Format.swarm:
+                    header = derep_id(seq) + "_" + str(list_id_counts[index])
+                elif id_format == Format.bestid and index in dict_bestid:
+                    header = dict_bestid[index]
+                else:
+                    continue
+                write_rare(rare_handle, rare_writer, header, seq, counts_matrix.row_items(index))
+        close_rare_outputs(rare_handle, rare_writer)
+
+def write_dereps_spilled(output_fasta_file, output_counts_file, output_map_file, id_format, min_samples, min_count, counts_header=True):
+    num_files = len(good_fasta_files)
+    spill_run(num_files)
+    min_count = max(min_count, 1)
+
+    out_handle1 = sys.stdout
+    if output_fasta_file:
+        out_handle1 = happyfile.hopen_write_or_else(output_fasta_file)
+
+    if verbose:
+        print("Merging spilled runs: " + str(len(list_spill_runs)), file=sys.stderr)
+
+    counts_writer = None
+    if output_counts_file:
+        counts_writer = happymatrix.CountsWriter(output_counts_file, counts_column_names(), header=counts_header)
+
+    # map lines are sorted on the sequence and merge-joined with the merged uniques
+    out_handle3 = None
+    map_line = None
+    if output_map_file:
+        out_handle3 = happyfile.hopen_write_or_else(output_map_file)
+        map_run_handle.close()
+        in_handle = open(map_run_file)
+        map_lines = happysort.sort_lines(in_handle, map_run_seq, os.path.dirname(map_run_file))
+        map_line = next(map_lines, None)
+
+    rare_handle, rare_writer = open_rare_outputs(counts_header)
+
+    for seq, samplecounts, bestid in merge_spill_runs(num_files):
+        count = sum(samplecounts)
+        num_samples = len(samplecounts) - samplecounts.count(0)
+        keep = num_samples >= min_samples and count >= min_count
+        if keep:
+            id = derep_id(seq) + "_" + str(count)
+            if id_format == Format.bestid:
+                id = re.split('\s', bestid)[0]
+            if id_format == Format.swarm:
+                print(">" + id + "\n" + seq, file=out_handle1)
+            elif id_format == Format.bestid:
+                print(">" + bestid + "\n" + seq, file=out_handle1)
+            if counts_writer:
+                counts_writer.write_row(id, enumerate(samplecounts))
+        elif count and (rare_handle or rare_writer):
+            header = derep_id(seq) + "_" + str(count)
+            if id_format == Format.bestid:
+                header = bestid
+            write_rare(rare_handle, rare_writer, header, seq, enumerate(samplecounts))
+
+        while map_line is not None and map_run_seq(map_line) <= seq:
+            if keep and map_run_seq(map_line) == seq:
+                print(id + "\t" + map_line.rstrip("\n").split("\t", 1)[1], file=out_handle3)
+            map_line = next(map_lines, None)
+
+    del list_spill_runs[:]
+    out_handle1.close()
+    close_rare_outputs(rare_handle, rare_writer)
+    if counts_writer:
+        counts_writer.close()
+    if out_handle3:
+        in_handle.close()
+        os.remove(map_run_file)
         out_handle3.close()
 
 def test_derep():
+    global keep_bestid
     retval = True
     seq = "acgtcatgcatctagctactacgagcacgatcatcgtagc"
     key = "6db096a7187e871007152ab79c856ec7d50236b6"
-    derep_line("testid1", seq, 1)
-    derep_line("testid2", seq, 2)
-    if dict_id_counts.get(key,0) == 2 and dict_id_file_counts.get((key, 1),0) == 1 and dict_id_map.get("testid2","") == key and dict_id_seq.get(key, "") == seq:
+    keep_bestid = True
+    derep_line("testid1", seq.upper())
+    merge_file(0)
+    dict_file_counts.clear()
+    del list_file_ids[:]
+    derep_line("testid2", seq)
+    merge_file(1)
+    index = seq_arena.index(seq)
+    counts_matrix = happymatrix.coo_to_csr(counts_coo, len(seq_arena), 2)
+    if index == 0 and counts_matrix.row_sums()[0] == 2 and counts_matrix.row_dense(0) == [1, 1] and dict_bestid.get(0, "") == "testid1" and derep_id(seq_arena[0]) == key:
         print("[fasta_dereplicate] test_derep: passed", file=sys.stderr)
     else:
         print("[fasta_dereplicate] test_derep: failed", file=sys.stderr)
         retval = False
     return retval
 
+def test_map_sort():
+    retval = True
+    lines = ["2\tr1\n", "0\tr2\n", "10\tr3\n", "2\tr4\n", "0\tr5\n"]
+    sorted_lines = list(happysort.sort_lines(lines, map_run_index, None, 2))
+    if sorted_lines == ["0\tr2\n", "0\tr5\n", "2\tr1\n", "2\tr4\n", "10\tr3\n"]:
+        print("[fasta_dereplicate] test_map_sort: passed", file=sys.stderr)
+    else:
+        print("[fasta_dereplicate] test_map_sort: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_spill():
+    global spill_dir
+    retval = True
+    spill_dir = tempfile.gettempdir()
+    del list_file_ids[:]
+    dict_file_counts.clear()
+    dict_file_counts.update({"ccc" : 2, "aaa" : 1})
+    merge_file(0)
+    spill_run(1)
+    dict_file_counts.clear()
+    dict_file_counts.update({"bbb" : 4, "aaa" : 3})
+    merge_file(1)
+    spill_run(2)
+    merged = [x for x in merge_spill_runs(2) if len(x[0]) == 3]
+    del list_spill_runs[:]
+    if merged == [("aaa", [1, 3], ""), ("bbb", [0, 4], ""), ("ccc", [2, 0], "")]:
+        print("[fasta_dereplicate] test_spill: passed", file=sys.stderr)
+    else:
+        print("[fasta_dereplicate] test_spill: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_store():
+    global seq_arena
+    global dict_bestid
+    global counts_coo
+    global good_fasta_files
+    global keep_bestid
+    retval = True
+    store_dir = tempfile.mkdtemp(prefix="fasta_dereplicate.")
+    keep_bestid = True
+    seq_arena = happyarena.SeqArena()
+    for name, records in [("a.fa", ">r1\nACGT\n>r2\nacgt\n>r3\nGGCC\n"), ("b.fa", ">r4\nTTAA\n>r5\nGGCC\n")]:
+        out_handle = open(os.path.join(store_dir, name), 'w')
+        out_handle.write(records)
+        out_handle.close()
+        add_store_file(store_dir, os.path.join(store_dir, name), read_fasta_records(os.path.join(store_dir, name)), 1)
+    remove_store_sample(store_dir, os.path.join(store_dir, "a.fa"))
+    add_store_file(store_dir, os.path.join(store_dir, "a.fa"), read_fasta_records(os.path.join(store_dir, "a.fa")), 1)
+    dict_bestid = {}
+    counts_coo = happymatrix.CountsCOO()
+    good_fasta_files = []
+    load_store_counts(store_dir)
+    counts_matrix = happymatrix.coo_to_csr(counts_coo, len(seq_arena), len(good_fasta_files))
+    shutil.rmtree(store_dir)
+    del list_store_samples[:]
+    if list(seq_arena) == ["acgt", "ggcc", "ttaa"] and [counts_matrix.row_dense(i) for i in range(3)] == [[0, 2], [1, 1], [1, 0]] and dict_bestid == {0 : "r1", 1 : "r5", 2 : "r4"}:
+        print("[fasta_dereplicate] test_store: passed", file=sys.stderr)
+    else:
+        print("[fasta_dereplicate] test_store: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_store_remove():
+    global seq_arena
+    global dict_bestid
+    global counts_coo
+    global good_fasta_files
+    global keep_bestid
+    global rare_fasta_file
+    global rare_counts_file
+    retval = True
+    store_dir = tempfile.mkdtemp(prefix="fasta_dereplicate.")
+    keep_bestid = True
+    seq_arena = happyarena.SeqArena()
+    for name, records in [("a.fa", ">r1\nACGT\n>r2\nACGT\n>r3\nGGCC\n"), ("b.fa", ">r4\nTTAA\n>r5\nGGCC\n>r6\nGGCC\n")]:
+        out_handle = open(os.path.join(store_dir, name), 'w')
+        out_handle.write(records)
+        out_handle.close()
+        add_store_file(store_dir, os.path.join(store_dir, name), read_fasta_records(os.path.join(store_dir, name)), 1)
+    remove_store_sample(store_dir, os.path.join(store_dir, "a.fa"))
+    compact_store(store_dir)
+    dict_bestid = {}
+    counts_coo = happymatrix.CountsCOO()
+    good_fasta_files = []
+    load_store_counts(store_dir)
+    rare_fasta_file = os.path.join(store_dir, "rare.fa")
+    rare_counts_file = os.path.join(store_dir, "rare.counts")
+    write_dereps(os.path.join(store_dir, "out.fa"), os.path.join(store_dir, "out.counts"), "", Format.swarm, 1, 2)
+    rare_fasta_file = ""
+    rare_counts_file = ""
+    dict_output = {}
+    for name in ["uniques.txt", "out.fa", "out.counts", "rare.fa", "rare.counts"]:
+        in_handle = open(os.path.join(store_dir, name))
+        dict_output[name] = [line.rstrip("\n") for line in in_handle]
+        in_handle.close()
+    shutil.rmtree(store_dir)
+    del list_store_samples[:]
+    if dict_output["uniques.txt"] == ["ggcc", "ttaa"] and [line for line in dict_output["out.fa"] if not line.startswith(">")] == ["ggcc"] and [line for line in dict_output["rare.fa"] if not line.startswith(">")] == ["ttaa"] and len(dict_output["out.counts"]) == 2 and len(dict_output["rare.counts"]) == 2:
+        print("[fasta_dereplicate] test_store_remove: passed", file=sys.stderr)
+    else:
+        print("[fasta_dereplicate] test_store_remove: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_counts_npz():
+    retval = True
+    fd, npz_file = tempfile.mkstemp(suffix=".npz")
+    os.close(fd)
+    counts_writer = happymatrix.CountsWriter(npz_file, ["s1", "s2", "s3"], ['id', 'taxonomy'])
+    counts_writer.write_row("otu1", [(0, 5), (2, 1)], ["Bacteria;Proteobacteria"])
+    counts_writer.write_row("otu2", [(1, 0)], [""])
+    counts_writer.close()
+    counts_reader = happymatrix.CountsReader(npz_file)
+    rows = [(id, fields, list(items)) for id, fields, items in counts_reader.rows()]
+    os.remove(npz_file)
+    if counts_reader.col_names == ["s1", "s2", "s3"] and rows == [("otu1", ["Bacteria;Proteobacteria"], [(0, 5), (2, 1)]), ("otu2", [""], [])]:
+        print("[fasta_dereplicate] test_counts_npz: passed", file=sys.stderr)
+    else:
+        print("[fasta_dereplicate] test_counts_npz: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_sketch():
+    global sketch_counts
+    global sketch_samples
+    retval = True
+    fasta_dir = tempfile.mkdtemp(prefix="fasta_dereplicate.")
+    fasta_files = []
+    for name, records in [("a.fa", ">r1\nACGT\n>r2\nacgt\n>r3\nGGCC\n"), ("b.fa", ">r4\nTTAA\n>r5\nGGCC\n>r6\nACGT\n")]:
+        fasta_files.append(os.path.join(fasta_dir, name))
+        out_handle = open(fasta_files[-1], 'w')
+        out_handle.write(records)
+        out_handle.close()
+    build_sketch(fasta_files, 65536, 2, 3)
+    kept = [seq for seq in ["acgt", "GGCC", "ttaa"] if sketch_keep(seq)]
+    sketch_counts = None
+    sketch_samples = None
+    shutil.rmtree(fasta_dir)
+    if kept == ["acgt"]:
+        print("[fasta_dereplicate] test_sketch: passed", file=sys.stderr)
+    else:
+        print("[fasta_dereplicate] test_sketch: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_arena():
+    retval = True
+    arena = happyarena.SeqArena()
+    for seq in ["acgt", "ggcc", "acgt", "a" * 100, "ggcc"]:
+        arena.add(seq)
+    fd, arena_file = tempfile.mkstemp(suffix=".arena")
+    os.close(fd)
+    arena.save(arena_file)
+    mapped = happyarena.load_arena(arena_file)
+    seqs = list(mapped)
+    index = mapped.index("a" * 100)
+    missing = mapped.index("acg")
+    os.remove(arena_file)
+    if seqs == ["acgt", "ggcc", "a" * 100] and index == 2 and missing == -1:
+        print("[fasta_dereplicate] test_arena: passed", file=sys.stderr)
+    else:
+        print("[fasta_dereplicate] test_arena: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_readers():
+    global readers
+    global batch_size
+    retval = True
+    fasta_dir = tempfile.mkdtemp(prefix="fasta_dereplicate.")
+    fasta_files = []
+    for i in range(5):
+        fasta_files.append(os.path.join(fasta_dir, "s" + str(i) + ".fa"))
+        out_handle = open(fasta_files[-1], 'w')
+        out_handle.write("".join(">r" + str(i) + "_" + str(j) + "\nACGT\n" for j in range(7)))
+        out_handle.close()
+    readers, batch_size = 3, 2
+    files_ids = [(os.path.basename(fasta_file), [id for id, seq in records]) for fasta_file, records in read_fasta_files(fasta_files)]
+    readers, batch_size = 1, 10000
+    shutil.rmtree(fasta_dir)
+    if files_ids == [("s" + str(i) + ".fa", ["r" + str(i) + "_" + str(j) for j in range(7)]) for i in range(5)]:
+        print("[fasta_dereplicate] test_readers: passed", file=sys.stderr)
+    else:
+        print("[fasta_dereplicate] test_readers: failed", file=sys.stderr)
+        retval = False
+    return retval
+
 def test_all():
-    if not test_derep():
+    if not (test_derep() and test_map_sort() and test_spill() and test_store() and test_store_remove() and test_counts_npz() and test_sketch() and test_arena() and test_readers()):
         sys.exit(2)
 
 ###
@@ -212,7 +1035,7 @@ def main(argv):
         "",
         "Usage: " + os.path.basename(argv[0]) + " (options) [FASTA file(s)...]",
         "   -o file        : output FASTA file (default: stdout)",
-        "   -c file        : output sample counts file",
+        "   -c file        : output sample counts file (.npz for sparse binary, default: TSV)",
         "   -m file        : output ID map table",
         "   -n file        : sample names file",
         "   -l int         : minimum samples (default: 1)",
@@ -220,10 +1043,25 @@ def main(argv):
         "   -s, --swarm    : output format: swarm (default)",
         "   -b, --bestid   : output format: best ID",
         "   --fasta_min    : minimum sample sequences (default: 100)",
+        "   -x, --cpus int : number of processes, partitioned by sequence (default: 1)",
+        "   -d dir         : dereplication store folder, FASTA files are added to it",
+        "   --remove file  : remove sample FASTA file from store (-d)",
+        "   --readers int  : number of FASTA files read ahead concurrently on threads (default: 1)",
+        "   --sketch float : first pass counts sequences in a count-min sketch of this size in MB,",
+        "                    and only uniques that can pass -t and -l are stored (default: 0, off)",
+        "   --max-memory float : memory budget in MB, uniques beyond it are spilled to disk (default: 0, off)",
+        "   --rare_fa file : output FASTA of uniques below -t or -l, for recruitment by swarm_map",
+        "   --rare_counts file : output sample counts of uniques below -t or -l",
         "   -h, --help     : help",
         "   -v, --verbose  : more information to stderr", ""])
 
     global verbose
+    global keep_bestid
+    global max_memory
+    global spill_dir
+    global readers
+    global rare_fasta_file
+    global rare_counts_file
     fasta_files = []
     sample_names_file = ""
     output_fasta_file = ""
@@ -233,9 +1071,13 @@ def main(argv):
     min_count = 1
     min_samples = 1
     min_fasta = 100
+    cpus = 1
+    store_dir = ""
+    remove_files = []
+    sketch_bytes = 0
     
     try:
-        opts, args = getopt.getopt(argv[1:], "o:c:m:n:t:l:sbhv", ["swarm", "bestid", "fasta_min", "help", "verbose", "test"])
+        opts, args = getopt.getopt(argv[1:], "o:c:m:n:t:l:x:d:sbhv", ["swarm", "bestid", "fasta_min", "cpus=", "remove=", "readers=", "sketch=", "max-memory=", "rare_fa=", "rare_counts=", "help", "verbose", "test"])
     except getopt.GetoptError:
         print(help, file=sys.stderr)
         sys.exit(2)
@@ -265,34 +1107,98 @@ def main(argv):
             id_format = Format.bestid
         elif opt == '--fasta_min':
             min_fasta = int(re.sub('=','', arg))
+        elif opt in ("-x", "--cpus"):
+            cpus = int(re.sub('=','', arg))
+        elif opt == '-d':
+            store_dir = arg
+        elif opt == '--remove':
+            remove_files.append(arg)
+        elif opt == '--readers':
+            readers = int(re.sub('=','', arg))
+        elif opt == '--sketch':
+            sketch_bytes = int(float(re.sub('=','', arg)) * 1048576)
+        elif opt == '--max-memory':
+            max_memory = int(float(re.sub('=','', arg)) * 1048576)
+        elif opt == '--rare_fa':
+            rare_fasta_file = arg
+        elif opt == '--rare_counts':
+            rare_counts_file = arg
         elif opt in ("-v", "--verbose"):
             verbose = True
 
     if len(args) > 0:
         fasta_files = args
-    else:
+    elif not store_dir:
         print(help, file=sys.stderr)
         sys.exit(2)
 
+    if store_dir and (cpus > 1 or max_memory or sketch_bytes):
+        print(help + "\nA dereplication store (-d) is updated by a single process, without --max-memory or --sketch", file=sys.stderr)
+        sys.exit(2)
+
+    if sketch_bytes and (rare_fasta_file or rare_counts_file):
+        print(help + "\nRare uniques (--rare_fa, --rare_counts) are not kept with --sketch", file=sys.stderr)
+        sys.exit(2)
+
     if verbose:
         if len(fasta_files) > 1:
             print("input fasta files:    " + fasta_files[0], file=sys.stderr)
             print("\n".join("                      " + x for x in fasta_files[1:]), file=sys.stderr)
-        else:
+        elif fasta_files:
             print("input fasta file:     " + fasta_files[0], file=sys.stderr)
 
         print("\n".join([
             "output fasta file:    " + output_fasta_file,
             "output counts file:   " + output_counts_file,
             "output map file:      " + output_map_file,
+            "rare fasta file:      " + rare_fasta_file,
+            "rare counts file:     " + rare_counts_file,
             "output id format:     " + ("swarm", "bestid")[id_format-1],
             "minimum total counts: " + str(min_count),
             "minimum samples:      " + str(min_samples),
-            "minimum sequences:    " + str(min_fasta)]), file=sys.stderr)
+            "minimum sequences:    " + str(min_fasta),
+            "cpus:                 " + str(cpus),
+            "readers:              " + str(readers),
+            "store folder:         " + store_dir,
+            "sketch (bytes):       " + str(sketch_bytes),
+            "max memory (bytes):   " + str(max_memory)]), file=sys.stderr)
 
     read_sample_names(sample_names_file)
-    derep_fasta(fasta_files, min_fasta)
-    write_dereps(output_fasta_file, output_counts_file, output_map_file, id_format, min_samples, min_count)
+
+    if max_memory:
+        spill_dir = os.path.dirname(os.path.abspath(output_fasta_file or output_counts_file or "derep"))
+
+    if sketch_bytes:
+        build_sketch(fasta_files, sketch_bytes, min_samples, min_count)
+
+    if store_dir:
+        keep_bestid = True
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        read_store(store_dir)
+        for fasta_file in remove_files:
+            if not remove_store_sample(store_dir, fasta_file):
+                print("[fasta_dereplicate] Not in store: " + fasta_file, file=sys.stderr)
+        for fasta_file, records in read_fasta_files(fasta_files):
+            add_store_file(store_dir, fasta_file, records, min_fasta)
+        write_store_samples(store_dir)
+        compact_store(store_dir)
+
+        if output_map_file:
+            open_map_run(output_map_file)
+        load_store_counts(store_dir)
+        write_dereps(output_fasta_file, output_counts_file, output_map_file, id_format, min_samples, min_count)
+    elif cpus > 1:
+        if max_memory:
+            max_memory = max(1, max_memory // cpus)
+        derep_fasta_partitioned(fasta_files, min_fasta, cpus, output_fasta_file, output_counts_file, output_map_file, id_format, min_samples, min_count)
+    else:
+        keep_bestid = (id_format == Format.bestid)
+        if output_map_file:
+            open_map_run(output_map_file)
+
+        derep_fasta(fasta_files, min_fasta)
+        write_dereps(output_fasta_file, output_counts_file, output_map_file, id_format, min_samples, min_count)
 
 if __name__ == "__main__":
     main(sys.argv)
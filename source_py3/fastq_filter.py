@@ -11,6 +11,8 @@
 # La Jolla, CA USA
 #
 import sys, re, os, getopt
+import math
+from collections import Counter
 import happyfile
 
 dict_chimera_ids = {}
@@ -21,7 +23,10 @@ count_long_seqs = 0
 count_non_acgt = 0
 count_chimeras = 0
 count_low_quality = 0
+count_low_complexity = 0
 count_passed = 0
+list_batch = []
+batch_size = 10000
 
 def read_chimeras(chimera_file):
     global dict_chimera_ids
@@ -41,7 +46,37 @@ def read_chimeras(chimera_file):
         if cols[16] == 'Y':
             dict_chimera_ids[cols[1]] = 1
 
-def filter_line(out_handle, id, seq, qual, min_quality, min_seq_len, max_seq_len):
+def triplet_entropies(seqs):
+    # Shannon entropy (bits) of the overlapping triplet composition of each sequence
+    dict_seq_entropy = {}
+    entropies = []
+    for seq in seqs:
+        if not seq in dict_seq_entropy:
+            n = len(seq) - 2
+            if n < 1:
+                dict_seq_entropy[seq] = 0.0
+            else:
+                counts = Counter(map(''.join, zip(seq, seq[1:], seq[2:]))).values()
+                dict_seq_entropy[seq] = math.log(n, 2) - sum(c * math.log(c, 2) for c in counts) / n
+        entropies.append(dict_seq_entropy[seq])
+    return entropies
+
+def filter_batch(min_entropy):
+    global count_low_complexity
+    global count_passed
+    global list_batch
+
+    entropies = triplet_entropies([seq.lower() for out_handle, id, seq in list_batch])
+    for i in range(len(list_batch)):
+        if entropies[i] < min_entropy:
+            count_low_complexity += 1
+        else:
+            count_passed += 1
+            out_handle, id, seq = list_batch[i]
+            print(">" + id + "\n" + seq, file=out_handle)
+    list_batch = []
+
+def filter_line(out_handle, id, seq, qual, min_quality, min_seq_len, max_seq_len, min_entropy):
     global count_total
     global count_short_seqs
     global count_long_seqs
@@ -76,10 +111,16 @@ def filter_line(out_handle, id, seq, qual, min_quality, min_seq_len, max_seq_len
             lastbad = thisbad
 
     if not skipline:
-        count_passed += 1
-        print(">" + id + "\n" + seq, file=out_handle)
+        if min_entropy > 0:
+            # low complexity is scored last, on batches of otherwise passing reads
+            list_batch.append((out_handle, id, seq))
+            if len(list_batch) >= batch_size:
+                filter_batch(min_entropy)
+        else:
+            count_passed += 1
+            print(">" + id + "\n" + seq, file=out_handle)
 
-def filter_fastq(fastq_file, output_file, min_quality, min_seq_len, max_seq_len):
+def filter_fastq(fastq_file, output_file, min_quality, min_seq_len, max_seq_len, min_entropy):
     in_handle = happyfile.hopen_or_else(fastq_file)
     
     if verbose:
@@ -107,12 +148,27 @@ def filter_fastq(fastq_file, output_file, min_quality, min_seq_len, max_seq_len)
             seq = line
         elif rnum == 4:
             qual = line
-            filter_line(out_handle, id, seq, qual, min_quality, min_seq_len, max_seq_len)
+            filter_line(out_handle, id, seq, qual, min_quality, min_seq_len, max_seq_len, min_entropy)
         rnum += 1
         if rnum > 4:
             rnum = 1
 
+    if list_batch:
+        filter_batch(min_entropy)
+
+def test_entropy():
+    retval = True
+    low, high = triplet_entropies(["aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa", "acgtcatgcatctagctactacgagcacgatcatcgtagc"])
+    if low == 0.0 and high > 4.0:
+        print("[fastq_filter] test_entropy: passed", file=sys.stderr)
+    else:
+        print("[fastq_filter] test_entropy: failed", file=sys.stderr)
+        retval = False
+    return retval
+
 def test_all():
+    if not test_entropy():
+        sys.exit(2)
     print("[fastq_filter] test_all: passed", file=sys.stderr)
 
 ###
@@ -129,6 +185,7 @@ def main(argv):
         "   -q int         : minimum quality score (default: 35)",
         "   -m int         : minimim sequence length (default: 50)",
         "   -x int         : maximum sequence length (default: Inf)",
+        "   -e float       : minimum triplet entropy, low complexity filter (default: 0, off)",
         "   -h, --help     : help",
         "   -v, --verbose  : more information to stderr", ""])
 
@@ -139,10 +196,11 @@ def main(argv):
     min_quality = 30
     min_seq_len = 50
     max_seq_len = float("Inf")
+    min_entropy = 0
     unused_args = []
     
     try:
-        opts, args = getopt.getopt(argv[1:], "f:o:c:q:m:x:hv", ["help", "verbose", "test"])
+        opts, args = getopt.getopt(argv[1:], "f:o:c:q:m:x:e:hv", ["help", "verbose", "test"])
     except getopt.GetoptError:
         print(help, file=sys.stderr)
         sys.exit(2)
@@ -166,6 +224,8 @@ def main(argv):
             min_seq_len = int(re.sub('=','', arg))
         elif opt == '-x':
             max_seq_len = int(re.sub('=','', arg))
+        elif opt == '-e':
+            min_entropy = float(re.sub('=','', arg))
         elif opt in ("-v", "--verbose"):
             verbose = True
         else:
@@ -188,12 +248,13 @@ def main(argv):
             "output file:  " + output_file,
             "min quality:  " + str(min_quality),
             "min seq len:  " + str(min_seq_len),
-            "max seq len:  " + str(max_seq_len)]), file=sys.stderr)
+            "max seq len:  " + str(max_seq_len),
+            "min entropy:  " + str(min_entropy)]), file=sys.stderr)
 
     if chimera_file:
         read_chimeras(chimera_file)
 
-    filter_fastq(fastq_file, output_file, min_quality, min_seq_len, max_seq_len)
+    filter_fastq(fastq_file, output_file, min_quality, min_seq_len, max_seq_len, min_entropy)
 
     if verbose and count_total:
         print("\n".join([
@@ -203,6 +264,7 @@ def main(argv):
             "seqs bad chars:   " + str(count_non_acgt) + " (" + str(round(100.0*count_non_acgt/count_total, 1)) + "%)",
             "seqs chimera:     " + str(count_chimeras) + " (" + str(round(100.0*count_chimeras/count_total, 1)) + "%)",
             "seqs low quality: " + str(count_low_quality) + " (" + str(round(100.0*count_low_quality/count_total, 1)) + "%)",
+            "seqs low complex: " + str(count_low_complexity) + " (" + str(round(100.0*count_low_complexity/count_total, 1)) + "%)",
             "seqs passed:      " + str(count_passed) + " (" + str(round(100.0*count_passed/count_total, 1)) + "%)"]), file=sys.stderr)
 
 if __name__ == "__main__":
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+## happysort - External merge sort of text lines through temporary run files
+## Part of rRNA_pipeline
+#
+# 1. sort_lines reads up to max_lines at a time, sorts them in memory, and writes each
+#    sorted run to a temporary file in tmp_dir.
+#
+# 2. Runs are k-way merged with heapq, so memory is bounded by max_lines plus one line per run.
+#    The sort is stable: equal keys keep their input order.
+#
+# 3. Temporary run files are removed once the merge has been consumed.
+#
+
+import os, heapq, tempfile
+
+def write_run(lines, tmp_dir):
+    fd, run_file = tempfile.mkstemp(prefix="happysort.", suffix=".run", dir=tmp_dir)
+    out_handle = os.fdopen(fd, 'w')
+    out_handle.writelines(lines)
+    out_handle.close()
+    return run_file
+
+def read_run(run_file, key, run_num):
+    in_handle = open(run_file)
+    pos = 0
+    for line in in_handle:
+        yield key(line), run_num, pos, line
+        pos += 1
+    in_handle.close()
+    os.remove(run_file)
+
+def sort_lines(lines, key, tmp_dir=None, max_lines=1000000):
+    # lines must end with a newline; yields lines in key order
+    run_files = []
+    buffer = []
+    for line in lines:
+        buffer.append(line)
+        if len(buffer) >= max_lines:
+            buffer.sort(key=key)
+            run_files.append(write_run(buffer, tmp_dir))
+            buffer = []
+    buffer.sort(key=key)
+
+    if not run_files:
+        for line in buffer:
+            yield line
+        return
+
+    runs = [read_run(run_files[i], key, i) for i in range(len(run_files))]
+    runs.append((key(buffer[i]), len(run_files), i, buffer[i]) for i in range(len(buffer)))
+    for k, run_num, pos, line in heapq.merge(*runs):
+        yield line
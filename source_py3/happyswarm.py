@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+#
+## happyswarm - Native swarm OTU clustering (d=1) of dereplicated amplicons, with fastidious grafting
+## Part of rRNA_pipeline
+#
+# 1. Amplicons are taken in order of decreasing abundance (ties by ID).  Each amplicon not yet in a swarm
+#    seeds a new swarm, which grows breadth-first: every member recruits its unassigned one-difference
+#    neighbours whose abundance is not higher than its own (swarm's default breaking rule).
+#
+# 2. One-difference neighbours are found by microvariant hashing: every substitution, deletion, and
+#    insertion of a sequence is looked up in a hash of the sequences being clustered.
+#
+# 3. Amplicons are first sharded into independent groups by union-find over cheap neighbour keys:
+#    two sequences one difference apart share an unchanged prefix or suffix of (n - 1) // 2 bases,
+#    n the shorter length.  Swarms never cross groups, so batches of whole groups are clustered in
+#    worker processes, or exported as FASTA partitions to cluster on other nodes, and merged in seed order.
+#
+# 4. Fastidious: swarms with mass (total abundance) below the boundary are light, the rest heavy.
+#    All microvariants of light amplicons go into a Bloom filter, hashed by CRC-32 so that every worker
+#    agrees whatever its start method; microvariants of heavy amplicons found in it are expanded once
+#    more, reaching light amplicons two differences away.  Each light swarm is
+#    grafted onto the heavy swarm of its most abundant partner, and appended to that swarm's line.
+#    Grafting can cross groups, so it runs after the merge, over all swarms.
+#
+# 5. Output is the swarm file format: one line per swarm, space-separated IDs, seed first.
+#
+
+import sys, re, binascii, zlib, multiprocessing
+import happyfile
+import happymatrix
+
+batch_size = 1000
+batch_amplicons = 10000
+fastidious_boundary = 3
+bloom_bits_per_variant = 16
+
+# worker state, inherited by forked workers through init_worker
+list_seqs = []
+list_abundance = []
+list_rank = []
+list_items = []
+dict_light_index = {}
+bloom_filter = None
+bloom_mask = 0
+
+def microvariants(seq):
+    # every sequence one substitution, deletion, or insertion away from seq
+    for i in range(len(seq)):
+        for c in "acgt":
+            if c != seq[i]:
+                yield seq[:i] + c + seq[i+1:]
+        yield seq[:i] + seq[i+1:]
+    for i in range(len(seq) + 1):
+        for c in "acgt":
+            yield seq[:i] + c + seq[i:]
+
+def amplicon_abundance(id):
+    m = re.search('(?:_|;size=)(\d+);?$', id)
+    if m:
+        return int(m.group(1))
+    return None
+
+def read_amplicons(fasta_file):
+    list_ids = []
+    seqs = []
+    in_handle = happyfile.hopen_or_else(fasta_file)
+    id = ""
+    seq = ""
+    while 1:
+        line = in_handle.readline()
+        if not line:
+            break
+        line = line.rstrip()
+
+        if line.startswith(">"):
+            if id:
+                list_ids.append(id)
+                seqs.append(seq.lower())
+            id = re.split('\s', line[1:])[0]
+            seq = ""
+        else:
+            seq += re.sub('\s', '', line)
+
+    if id:
+        list_ids.append(id)
+        seqs.append(seq.lower())
+    in_handle.close()
+    return list_ids, seqs
+
+def neighbor_keys(seq):
+    # keys shared by any two sequences one difference apart, for lengths (n, n) and (n, n + 1)
+    keys = []
+    for n in (len(seq), len(seq) - 1):
+        k = max(0, (n - 1) // 2)
+        keys.append((n, 0, seq[:k]))
+        keys.append((n, 1, seq[len(seq)-k:]))
+    return keys
+
+def find_groups(seqs):
+    # amplicon indices of each group, groups in order of their first amplicon
+    parent = happymatrix.int64_array(len(seqs))
+    for i in range(len(seqs)):
+        parent[i] = i
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    dict_key_index = {}
+    for i in range(len(seqs)):
+        for key in neighbor_keys(seqs[i]):
+            j = dict_key_index.setdefault(key, i)
+            if j != i:
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+    dict_key_index = None
+
+    dict_root_group = {}
+    groups = []
+    for i in range(len(seqs)):
+        root = find(i)
+        if not root in dict_root_group:
+            dict_root_group[root] = len(groups)
+            groups.append([])
+        groups[dict_root_group[root]].append(i)
+    return groups
+
+def group_batches(groups, max_amplicons):
+    # whole groups packed into batches of up to max_amplicons (or one larger group)
+    batches = []
+    batch = []
+    for group in groups:
+        if batch and len(batch) + len(group) > max_amplicons:
+            batches.append(batch)
+            batch = []
+        batch.extend(group)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def init_worker(seqs, abundance=[], rank=[], items=[], light_index={}, bloom=None):
+    global list_seqs
+    global list_abundance
+    global list_rank
+    global list_items
+    global dict_light_index
+    global bloom_filter
+    global bloom_mask
+    list_seqs = seqs
+    list_abundance = abundance
+    list_rank = rank
+    list_items = items
+    dict_light_index = light_index
+    bloom_filter = bloom
+    if bloom is not None:
+        bloom_mask = 8 * len(bloom) - 1
+
+def map_tasks(func, tasks, cpus, initargs, initializer=init_worker):
+    # func over tasks, results in order, on cpus worker processes set up by initializer(*initargs)
+    if cpus > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(cpus, len(tasks)), initializer, initargs)
+        for result in pool.imap(func, tasks):
+            yield result
+        pool.close()
+        pool.join()
+    else:
+        initializer(*initargs)
+        for task in tasks:
+            yield func(task)
+
+def cluster_batch(members):
+    # d=1 swarms of a batch of whole groups, as lists of amplicon indices
+    seq_index = {}
+    for i in members:
+        seq_index[list_seqs[i]] = i
+
+    assigned = set()
+    swarms = []
+    for seed in sorted(members, key=list_rank.__getitem__):
+        if seed in assigned:
+            continue
+        assigned.add(seed)
+        swarm = [seed]
+        k = 0
+        while k < len(swarm):
+            i = swarm[k]
+            k += 1
+            recruits = set()
+            for variant in microvariants(list_seqs[i]):
+                j = seq_index.get(variant)
+                if j is not None and not j in assigned and list_abundance[j] <= list_abundance[i]:
+                    recruits.add(j)
+            for j in sorted(recruits, key=list_rank.__getitem__):
+                assigned.add(j)
+                swarm.append(j)
+        swarms.append(swarm)
+    return swarms
+
+def abundance_rank(list_ids):
+    list_abundance = happymatrix.int64_array(len(list_ids))
+    for i in range(len(list_ids)):
+        abundance = amplicon_abundance(list_ids[i])
+        if abundance is None:
+            print("[happyswarm] ERROR: missing abundance in ID: " + list_ids[i], file=sys.stderr)
+            sys.exit(2)
+        list_abundance[i] = abundance
+
+    order = sorted(range(len(list_ids)), key=lambda i: (-list_abundance[i], list_ids[i]))
+    rank = happymatrix.int64_array(len(list_ids))
+    for r in range(len(order)):
+        rank[order[r]] = r
+    return list_abundance, rank
+
+def variant_hash(variant):
+    # 64 bits from two CRC-32s; unlike hash(), the same in every worker whatever its start method
+    data = variant.encode('ascii')
+    return (zlib.crc32(data) & 0xffffffff) | (zlib.crc32(data, 0x9e3779b9) & 0xffffffff) << 32
+
+def bloom_add(bloom, h):
+    p = h & bloom_mask
+    bloom[p >> 3] |= 1 << (p & 7)
+    p = (h >> 32) & bloom_mask
+    bloom[p >> 3] |= 1 << (p & 7)
+
+def bloom_contains(h):
+    p = h & bloom_mask
+    if not bloom_filter[p >> 3] & (1 << (p & 7)):
+        return False
+    p = (h >> 32) & bloom_mask
+    return bloom_filter[p >> 3] & (1 << (p & 7)) != 0
+
+def or_bytes(a, b):
+    value = int(binascii.hexlify(a), 16) | int(binascii.hexlify(b), 16)
+    return bytearray(binascii.unhexlify('%0*x' % (2 * len(a), value)))
+
+def light_bloom_stripe(bounds):
+    # Bloom filter of the microvariants of every step-th light amplicon, from start
+    start, step = bounds
+    bloom = bytearray(len(bloom_filter))
+    for i in list_items[start::step]:
+        for variant in microvariants(list_seqs[i]):
+            bloom_add(bloom, variant_hash(variant))
+    return bloom
+
+def graft_batch(bounds):
+    # (heavy, light) amplicon pairs at most two differences apart
+    start, end = bounds
+    result = []
+    for i in list_items[start:end]:
+        found = set()
+        for variant in microvariants(list_seqs[i]):
+            j = dict_light_index.get(variant)
+            if j is not None:
+                found.add(j)
+            if bloom_contains(variant_hash(variant)):
+                for variant2 in microvariants(variant):
+                    j = dict_light_index.get(variant2)
+                    if j is not None:
+                        found.add(j)
+        result.extend((i, j) for j in sorted(found))
+    return result
+
+def graft_light_swarms(seqs, list_abundance, swarms, rank, boundary, cpus):
+    swarm_of = happymatrix.int64_array(len(seqs))
+    list_light = []
+    list_heavy = []
+    for s in range(len(swarms)):
+        for i in swarms[s]:
+            swarm_of[i] = s
+        if sum(list_abundance[i] for i in swarms[s]) < boundary:
+            list_light.extend(swarms[s])
+        else:
+            list_heavy.extend(swarms[s])
+    if not list_light or not list_heavy:
+        return swarms
+
+    light_index = {}
+    num_variants = 0
+    for i in list_light:
+        light_index[seqs[i]] = i
+        num_variants += 8 * len(seqs[i]) + 4
+    bloom_size = 8
+    while 8 * bloom_size < bloom_bits_per_variant * num_variants:
+        bloom_size *= 2
+
+    # Bloom filter stripes are built by separate workers and combined
+    bloom = bytearray(bloom_size)
+    stripes = max(1, min(cpus, len(list_light)))
+    initargs = (seqs, [], [], list_light, {}, bloom)
+    if stripes > 1:
+        pool = multiprocessing.Pool(stripes, init_worker, initargs)
+        for stripe_bloom in pool.imap(light_bloom_stripe, [(k, stripes) for k in range(stripes)]):
+            bloom = or_bytes(bloom, stripe_bloom)
+        pool.close()
+        pool.join()
+    else:
+        init_worker(*initargs)
+        bloom = light_bloom_stripe((0, 1))
+
+    candidates = []
+    list_bounds = [(i, min(i + batch_size, len(list_heavy))) for i in range(0, len(list_heavy), batch_size)]
+    for result in map_tasks(graft_batch, list_bounds, cpus, (seqs, [], [], list_heavy, light_index, bloom)):
+        candidates.extend(result)
+
+    # each light swarm is grafted once, onto the heavy swarm of its most abundant partner
+    candidates.sort(key=lambda pair: (-list_abundance[pair[0]], rank[pair[0]], rank[pair[1]]))
+    grafted = set()
+    dict_swarm_grafts = {}
+    for heavy, light in candidates:
+        light_swarm = swarm_of[light]
+        if not light_swarm in grafted:
+            grafted.add(light_swarm)
+            dict_swarm_grafts.setdefault(swarm_of[heavy], []).append(light_swarm)
+
+    result = []
+    for s in range(len(swarms)):
+        if not s in grafted:
+            members = list(swarms[s])
+            for light_swarm in dict_swarm_grafts.get(s, []):
+                members.extend(swarms[light_swarm])
+            result.append(members)
+    return result
+
+def cluster(list_ids, seqs, cpus=1, fastidious=True, boundary=fastidious_boundary):
+    # swarms as lists of amplicon indices, seed first, in seed order
+    list_abundance, rank = abundance_rank(list_ids)
+
+    batches = group_batches(find_groups(seqs), batch_amplicons)
+    swarms = []
+    for result in map_tasks(cluster_batch, batches, cpus, (seqs, list_abundance, rank)):
+        swarms.extend(result)
+    swarms.sort(key=lambda swarm: rank[swarm[0]])
+
+    if fastidious:
+        swarms = graft_light_swarms(seqs, list_abundance, swarms, rank, boundary, cpus)
+    init_worker([])
+    return swarms
+
+def write_swarms(swarm_file, list_ids, swarms):
+    out_handle = happyfile.hopen_write_or_else(swarm_file)
+    for members in swarms:
+        print(" ".join(list_ids[i] for i in members), file=out_handle)
+    out_handle.close()
+
+def run_swarm(fasta_file, swarm_file, cpus=1, fastidious=True):
+    list_ids, seqs = read_amplicons(fasta_file)
+    swarms = cluster(list_ids, seqs, cpus, fastidious)
+    write_swarms(swarm_file, list_ids, swarms)
+
+def export_partitions(fasta_file, num_parts, part_base):
+    # whole groups written to num_parts FASTA files of similar size, largest groups first
+    list_ids, seqs = read_amplicons(fasta_file)
+    groups = find_groups(seqs)
+    part_of = happymatrix.int32_array(len(seqs))
+    part_sizes = [0] * num_parts
+    for group in sorted(groups, key=len, reverse=True):
+        part = part_sizes.index(min(part_sizes))
+        part_sizes[part] += len(group)
+        for i in group:
+            part_of[i] = part
+
+    part_files = [part_base + ".part" + str(part) + ".fa" for part in range(num_parts)]
+    list_handles = [happyfile.hopen_write_or_else(part_file) for part_file in part_files]
+    for i in range(len(seqs)):
+        print(">" + list_ids[i] + "\n" + seqs[i], file=list_handles[part_of[i]])
+    for out_handle in list_handles:
+        out_handle.close()
+    return part_files
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+## happyunoise - UNOISE-style denoising of dereplicated amplicons into exact sequence variants (ASVs)
+## Part of rRNA_pipeline
+#
+# 1. Amplicons are taken in order of decreasing abundance (ties by ID).  An amplicon is an error of a
+#    more abundant centroid d differences away if its abundance skew is at most 1 / 2^(alpha * d + 1)
+#    (UNOISE, alpha = 2 by default); it then joins the closest such centroid (ties to the most abundant).
+#    Otherwise it becomes a new centroid, the seed of an ASV.
+#
+# 2. Candidate centroids are found with a k-mer prefix filter: d edits remove at most k * d of a
+#    sequence's distinct k-mers, so any centroid within d shares one of its k * d + 1 rarest k-mers.
+#    Candidates are verified by a banded edit distance, bounded by their largest allowed d.
+#
+# 3. The skew bound means only centroids at least 2^(alpha + 1) times as abundant can absorb an amplicon,
+#    so amplicons are taken in tiers within that abundance ratio of the tier's most abundant.  A tier
+#    depends only on centroids of earlier tiers, and its amplicons are denoised in parallel worker
+#    processes, with the same result as one at a time.
+#
+# 4. Output is the swarm file format: one line per ASV, space-separated IDs, centroid first.
+#
+
+import happyswarm
+
+unoise_alpha = 2.0
+kmer_size = 8
+max_diffs = 10
+batch_size = 1000
+
+# worker state, inherited by forked workers through init_worker; sequences and abundances are happyswarm's
+list_centroids = []
+dict_kmer_centroids = {}
+alpha = unoise_alpha
+
+def kmers(seq):
+    return set(seq[i:i+kmer_size] for i in range(len(seq) - kmer_size + 1))
+
+def skew_diffs(centroid_abundance, abundance, alpha):
+    # largest d with abundance / centroid_abundance <= 1 / 2^(alpha * d + 1), up to max_diffs
+    d = 0
+    while d < max_diffs and abundance * 2 ** (alpha * (d + 1) + 1) <= centroid_abundance:
+        d += 1
+    return d
+
+def banded_distance(a, b, max_d):
+    # edit distance of a and b if at most max_d, otherwise max_d + 1; row cells j - i in [-max_d, max_d]
+    big = max_d + 1
+    if abs(len(a) - len(b)) > max_d:
+        return big
+
+    # a shared prefix and suffix do not change the distance, and errors leave little else
+    n = min(len(a), len(b))
+    start = 0
+    while start < n and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < n - start and a[-1-end] == b[-1-end]:
+        end += 1
+    a = a[start:len(a)-end]
+    b = b[start:len(b)-end]
+
+    width = 2 * max_d + 1
+    prev = [big] * max_d + [j if j <= len(b) else big for j in range(max_d + 1)]
+    for i in range(1, len(a) + 1):
+        cur = [big] * width
+        c = a[i-1]
+        row_min = big
+        for k in range(max(0, max_d - i), min(width, len(b) - i + max_d + 1)):
+            j = i + k - max_d
+            if j == 0:
+                v = i
+            else:
+                v = prev[k] + (c != b[j-1])
+                if k + 1 < width and prev[k+1] < v:
+                    v = prev[k+1] + 1
+                if k > 0 and cur[k-1] < v:
+                    v = cur[k-1] + 1
+            if v < big:
+                cur[k] = v
+                if v < row_min:
+                    row_min = v
+        if row_min == big:
+            return big
+        prev = cur
+    return prev[len(b) - len(a) + max_d]
+
+def init_worker(seqs, abundance=[], centroids=[], kmer_centroids={}, skew_alpha=unoise_alpha):
+    global list_centroids
+    global dict_kmer_centroids
+    global alpha
+    happyswarm.init_worker(seqs, abundance)
+    list_centroids = centroids
+    dict_kmer_centroids = kmer_centroids
+    alpha = skew_alpha
+
+def find_centroid(i):
+    # centroid number that amplicon i is an error of, or -1
+    if not list_centroids:
+        return -1
+    list_seqs = happyswarm.list_seqs
+    list_abundance = happyswarm.list_abundance
+    seq = list_seqs[i]
+    abundance = list_abundance[i]
+    max_d = skew_diffs(list_abundance[list_centroids[0]], abundance, alpha)
+    if max_d < 1:
+        return -1
+
+    seq_kmers = kmers(seq)
+    if len(seq_kmers) > kmer_size * max_d:
+        candidates = set()
+        for posting in sorted((dict_kmer_centroids.get(x, ()) for x in seq_kmers), key=len)[:kmer_size * max_d + 1]:
+            candidates.update(posting)
+    else:
+        candidates = range(len(list_centroids))
+
+    best = -1
+    best_d = max_d + 1
+    # centroid numbers are in abundance order, so the allowed d only falls
+    for c in sorted(candidates):
+        j = list_centroids[c]
+        limit = min(skew_diffs(list_abundance[j], abundance, alpha), best_d - 1)
+        if limit < 1:
+            break
+        d = banded_distance(seq, list_seqs[j], limit)
+        if d <= limit:
+            best = c
+            best_d = d
+    return best
+
+def denoise_batch(members):
+    return [find_centroid(i) for i in members]
+
+def denoise(list_ids, seqs, cpus=1, skew_alpha=unoise_alpha):
+    # ASVs as lists of amplicon indices, centroid first, in centroid order
+    list_abundance, rank = happyswarm.abundance_rank(list_ids)
+    order = sorted(range(len(seqs)), key=rank.__getitem__)
+
+    centroids = []
+    kmer_centroids = {}
+    asvs = []
+    start = 0
+    while start < len(order):
+        end = start
+        while end < len(order) and list_abundance[order[end]] * 2 ** (skew_alpha + 1) > list_abundance[order[start]]:
+            end += 1
+        tier = order[start:end]
+        tasks = [tier[k:k + batch_size] for k in range(0, len(tier), batch_size)]
+        results = []
+        for result in happyswarm.map_tasks(denoise_batch, tasks, cpus, (seqs, list_abundance, centroids, kmer_centroids, skew_alpha), init_worker):
+            results.extend(result)
+
+        for k in range(len(tier)):
+            i = tier[k]
+            if results[k] >= 0:
+                asvs[results[k]].append(i)
+            else:
+                for x in kmers(seqs[i]):
+                    kmer_centroids.setdefault(x, []).append(len(centroids))
+                centroids.append(i)
+                asvs.append([i])
+        start = end
+
+    init_worker([])
+    return asvs
+
+def run_unoise(fasta_file, swarm_file, cpus=1, skew_alpha=unoise_alpha):
+    # writes the swarm file of ASVs
+    list_ids, seqs = happyswarm.read_amplicons(fasta_file)
+    asvs = denoise(list_ids, seqs, cpus, skew_alpha)
+    happyswarm.write_swarms(swarm_file, list_ids, asvs)
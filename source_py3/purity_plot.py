@@ -10,8 +10,9 @@
 # J. Craig Venter Institute (JCVI)
 # La Jolla, CA USA
 #
-import sys, re, os, getopt
+import sys, re, os, getopt, tempfile, shutil
 import happyfile
+import happymatrix
 
 prog_path = os.path.realpath(sys.argv[0])
 prog_dir = os.path.dirname(prog_path)
@@ -19,9 +20,10 @@ R_script = os.path.join(prog_dir, "plot_OTU_purity.r")
 
 verbose = False
 
-dict_id_swarm = {}
-dict_id_counts = {}
-dict_derep_ids = {}
+dict_amplicon_index = {}
+amplicon_ids = []
+amplicon_swarm = happymatrix.int64_array()
+derep_selected = bytearray()
 dict_id_best_hit = {}
 dict_id_best_bs = {}
 dict_id_taxonomy = {}
@@ -38,49 +40,60 @@ def read_swarms(swarm_file):
         line = line.rstrip()
         
         id_list = re.split('\s', line)
+        seed = intern_id(id_list[0])
         for id in id_list:
-            dict_id_swarm[id] = id_list[0]
+            amplicon_swarm[intern_id(id)] = seed
     in_handle.close()
 
+def intern_id(id):
+    # amplicon IDs are numbered once, in swarm file order, and joined as numbers
+    index = dict_amplicon_index.get(id)
+    if index is None:
+        # the list holds the dict's own key strings, so each ID is stored once
+        index = len(amplicon_ids)
+        dict_amplicon_index[id] = index
+        amplicon_ids.append(id)
+        amplicon_swarm.append(-1)
+        derep_selected.append(0)
+    return index
+
+def amplicon_index(id):
+    # number of an interned ID, or -1
+    return dict_amplicon_index.get(id, -1)
+
+def swarm_id_of(index):
+    if amplicon_swarm[index] < 0:
+        return ""
+    return amplicon_ids[amplicon_swarm[index]]
+
 def read_swarm_counts(swarm_counts_file, min_swarm_count, top_swarms):
     dict_swarm_counts = {}
-    global dict_derep_ids
 
-    in_handle = happyfile.hopen_or_else(swarm_counts_file)
+    counts_reader = happymatrix.CountsReader(swarm_counts_file)
     
     if verbose:
         print("Reading swarm counts file: " + swarm_counts_file, file=sys.stderr)
         
-    firstline = 1
-    while 1:
-        line = in_handle.readline()
-        if not line:
-            break
-        line = line.rstrip()
-        
-        if not firstline:
-            cols = line.split("\t")
-            for i in range(1, len(cols)):
-                dict_swarm_counts[cols[0]] = dict_swarm_counts.get(cols[0], 0) + int(cols[i])
-        
-        firstline = 0
-
-    in_handle.close()
+    for swarm_id, fields, items in counts_reader.rows():
+        dict_swarm_counts[swarm_id] = dict_swarm_counts.get(swarm_id, 0) + sum(count for i, count in items)
 
     num_ids = 0
-    dict_top_swarms = {}
+    top_seeds = set()
     for swarm_id in sorted(dict_swarm_counts, key=dict_swarm_counts.get, reverse=True):
         if num_ids < top_swarms:
-            dict_top_swarms[swarm_id] = 1
             num_ids += 1
+            if dict_swarm_counts[swarm_id] >= min_swarm_count:
+                top_seeds.add(amplicon_index(swarm_id))
+    top_seeds.discard(-1)
 
-    for id in dict_id_swarm:
-        swarm_id = dict_id_swarm[id]
-        if swarm_id in dict_top_swarms and dict_swarm_counts.get(swarm_id, 0) >= min_swarm_count:
-            dict_derep_ids[id] = 1
+    num_derep_ids = 0
+    for index in range(len(amplicon_ids)):
+        if amplicon_swarm[index] in top_seeds:
+            derep_selected[index] = 1
+            num_derep_ids += 1
 
     if verbose:
-        print("Top purity content, swarms: " + str(len(dict_top_swarms)) + " derep ids: " + str(len(dict_derep_ids)), file=sys.stderr)
+        print("Top purity content, swarms: " + str(num_ids) + " derep ids: " + str(num_derep_ids), file=sys.stderr)
 
 def write_swarm_content(fasta_file, swarm_content_fasta_file):
     swarm_content_size = 0
@@ -102,8 +115,8 @@ def write_swarm_content(fasta_file, swarm_content_fasta_file):
         line = line.rstrip()
         
         if line.startswith(">"):
-            id = re.split('\s', line[1:])[0]
-            if id in dict_derep_ids:
+            index = amplicon_index(re.split('\s', line[1:])[0])
+            if index >= 0 and derep_selected[index]:
                 write_out = True
                 swarm_content_size += 1
             else:
@@ -180,6 +193,11 @@ def get_taxonomy(swarm_content_fasta_file, swarm_content_ggsearch_file, database
                 dict_id_taxonomy[id] = taxstr
     in_handle2.close()
 
+def selected_indices():
+    for index in range(len(derep_selected)):
+        if derep_selected[index]:
+            yield index
+
 def write_purity(output_swarm_content_tax_file, output_swarm_purity_file, output_purity_pdf):
     if output_swarm_content_tax_file:
         out_handle1 = happyfile.hopen_write_or_else(output_swarm_content_tax_file)
@@ -188,8 +206,9 @@ def write_purity(output_swarm_content_tax_file, output_swarm_purity_file, output
         
         print("\t".join(['id', 'swarm', 'besthit', 'taxonomy']), file=out_handle1)
 
-        for id in dict_derep_ids:
-            swarm_id = dict_id_swarm.get(id, "")
+        for index in selected_indices():
+            id = amplicon_ids[index]
+            swarm_id = swarm_id_of(index)
             besthit = dict_id_best_hit.get(id, "")
             tax = ""
             if besthit:
@@ -206,9 +225,10 @@ def write_purity(output_swarm_content_tax_file, output_swarm_purity_file, output
 
     count_all = {}
     count_same_tax = {}
-    for id in dict_derep_ids:
+    for index in selected_indices():
+        id = amplicon_ids[index]
         id_key, id_size = id.split('_')[:2]
-        swarm_id = dict_id_swarm.get(id, "")
+        swarm_id = swarm_id_of(index)
         
         derep_size = int(id_size)
         if derep_size < 1:
@@ -250,6 +270,28 @@ def write_purity(output_swarm_content_tax_file, output_swarm_purity_file, output
         print("[purity_plot] ERROR: " + R_script, file=sys.stderr)
         sys.exit(2)
 
+def test_content_ids():
+    retval = True
+    # top two OTUs by count are a_5 and d_3, and d_3 is below the minimum count
+    tmp_dir = tempfile.mkdtemp()
+    swarm_file = os.path.join(tmp_dir, "test.swarm")
+    counts_file = os.path.join(tmp_dir, "test.swarm.counts")
+    out_handle = open(swarm_file, 'w')
+    out_handle.write("a_5 b_2 c_1\nd_3 e_1\nf_1\n")
+    out_handle.close()
+    out_handle = open(counts_file, 'w')
+    out_handle.write("id\ts1\ts2\na_5\t6\t2\nd_3\t4\t0\nf_1\t1\t0\n")
+    out_handle.close()
+    read_swarms(swarm_file)
+    read_swarm_counts(counts_file, 5, 2)
+    shutil.rmtree(tmp_dir)
+    if [(amplicon_ids[index], swarm_id_of(index)) for index in selected_indices()] == [("a_5", "a_5"), ("b_2", "a_5"), ("c_1", "a_5")]:
+        print("[purity_plot] test_content_ids: passed", file=sys.stderr)
+    else:
+        print("[purity_plot] test_content_ids: failed", file=sys.stderr)
+        retval = False
+    return retval
+
 def test_progs():
     passed = True
     try:
@@ -269,7 +311,7 @@ def test_progs():
     return passed
 
 def test_all():
-    if not test_progs():
+    if not (test_content_ids() and test_progs()):
         sys.exit(2)
 
 ###
@@ -282,7 +324,7 @@ def main(argv):
         "Usage: " + os.path.basename(argv[0]) + " (options)",
         "   -f file        : dereplicated FASTA",
         "   -s file        : swarm file",
-        "   -c file        : swarm counts file",
+        "   -c file        : swarm counts file (TSV or .npz)",
         "   -d file        : database FASTA file",
         "   -m int         : minimum swarm OTU count (default: 0)",
         "   -n int         : top swarm OTUs (default: 100)",
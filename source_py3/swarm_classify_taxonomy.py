@@ -12,6 +12,7 @@
 #
 import sys, re, os, getopt
 import happyfile
+import happymatrix
 
 verbose = False
 
@@ -55,29 +56,17 @@ def read_counts(counts_file):
     global sample_list
     
     if counts_file:
-        in_handle = happyfile.hopen_or_else(counts_file)
+        counts_reader = happymatrix.CountsReader(counts_file)
         
         if verbose:
             print("Reading counts file: " + counts_file, file=sys.stderr)
         
-        firstline = 1
-        while 1:
-            line = in_handle.readline()
-            if not line:
-                break
-            line = line.rstrip()
-            
-            if firstline:
-                sample_list = line.split("\t")[1:]
-            else:
-                cols = line.split("\t")
-                for i in range(1, len(cols)):
-                    dict_swarm_sample_counts[cols[0], i-1] = int(cols[i])
-                    dict_swarm_counts[cols[0]] = dict_swarm_counts.get(cols[0], 0) + int(cols[i])
-            
-            firstline = 0
-                
-        in_handle.close()
+        sample_list = counts_reader.col_names
+        for swarm_id, fields, items in counts_reader.rows():
+            dict_swarm_counts[swarm_id] = dict_swarm_counts.get(swarm_id, 0)
+            for i, count in items:
+                dict_swarm_sample_counts[swarm_id, i] = count
+                dict_swarm_counts[swarm_id] += count
 
 def get_taxonomy(fasta_file, ggsearch_file, database_file, cpus):
     global dict_swarm_best_hit
@@ -141,34 +130,26 @@ def get_taxonomy(fasta_file, ggsearch_file, database_file, cpus):
     in_handle2.close()
 
 def write_swarms(output_counts_file):
-    out_handle = sys.stdout
-    if output_counts_file:
-        out_handle = happyfile.hopen_write_or_else(output_counts_file)
-
-    if verbose and output_counts_file:
-        print("Writing counts file: " + output_counts_file, file=sys.stderr)
-
-    column_names = ['id', 'besthit', 'taxonomy']
+    column_names = []
     for name in sample_list:
         if name in dict_sample_name:
             column_names.append(dict_sample_name[name])
         else:
             column_names.append(name)
 
-    print("\t".join(column_names), file=out_handle)
+    counts_writer = happymatrix.CountsWriter(output_counts_file, column_names, ['id', 'besthit', 'taxonomy'])
+
+    if verbose and output_counts_file:
+        print("Writing counts file: " + output_counts_file, file=sys.stderr)
 
     for swarm_id in dict_swarm_counts:
         besthit = dict_swarm_best_hit.get(swarm_id, "")
         tax = ""
         if besthit:
             tax = dict_id_taxonomy.get(besthit, "")
-        samplecounts = [swarm_id, besthit, tax]
-        for i in range(len(sample_list)):
-            samplecounts.append(dict_swarm_sample_counts.get((swarm_id, i), 0))
-        print("\t".join(str(x) for x in samplecounts), file=out_handle)
+        counts_writer.write_row(swarm_id, [(i, dict_swarm_sample_counts.get((swarm_id, i), 0)) for i in range(len(sample_list))], [besthit, tax])
 
-    if output_counts_file:
-        out_handle.close()
+    counts_writer.close()
 
 def test_all():
     print("[swarm_classify_taxonomy] test_all: passed", file=sys.stderr)
@@ -184,8 +165,8 @@ def main(argv):
         "   -f file        : swarm FASTA",
         "   -g file        : ggsearch -m8 file",
         "   -d file        : database FASTA file",
-        "   -c file        : swarm counts file",
-        "   -o file        : output counts file (default: stdout)",
+        "   -c file        : swarm counts file (TSV or .npz)",
+        "   -o file        : output counts file, .npz for sparse binary (default: stdout)",
         "   -n file        : sample names file (optional)",
         "   -t, --cpus int : number of processes to run ggsearch (default: 1)",
         "   -h, --help     : help",
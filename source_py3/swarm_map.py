@@ -10,20 +10,32 @@
 # J. Craig Venter Institute (JCVI)
 # La Jolla, CA USA
 #
-import sys, re, os, getopt
+import sys, re, os, getopt, array, itertools
+import subprocess, threading, hashlib, tempfile, shutil, multiprocessing
 import happyfile
+import happymatrix
+import happyarena
+import happysort
+import happyswarm
+import happyunoise
 
 verbose = False
+stream_sort_lines = 100000
 
 sample_list = []
 dict_sample_name = {}
-dict_id_sample_counts = {}
-dict_id_counts = {}
-dict_swarm_sample_counts = {}
+dict_amplicon_index = {}
+amplicon_ids = []
+amplicon_swarm = happymatrix.int64_array()
+amplicon_counts = happymatrix.int64_array()
+amplicon_coo = happymatrix.CountsCOO()
+dict_swarm_index = {}
+swarm_matrix = None
 dict_swarm_counts = {}
-dict_swarm_seq = {}
-dict_id_swarm = {}
+swarm_seqs = happyarena.SeqArena()
+dict_swarm_seq_index = {}
 dict_swarm_num_samples = {}
+dict_swarm_recruits = {}
 
 def read_sample_names(sample_names_file):
     global dict_sample_name
@@ -51,132 +63,459 @@ def read_sample_names(sample_names_file):
 
         in_handle.close()
 
+def number_swarms():
+    # OTUs numbered in order of first appearance over amplicons; seed_groups[seed] is the OTU number
+    num_amplicons = len(amplicon_ids)
+    seed_groups = array.array(happymatrix.int64_typecode, [-1]) * num_amplicons
+    list_swarm_ids = []
+    for index in range(num_amplicons):
+        seed = amplicon_swarm[index]
+        if seed >= 0 and seed_groups[seed] < 0:
+            seed_groups[seed] = len(list_swarm_ids)
+            dict_swarm_index[amplicon_ids[seed]] = len(list_swarm_ids)
+            list_swarm_ids.append(amplicon_ids[seed])
+    return seed_groups, list_swarm_ids
+
+def set_swarm_totals(list_swarm_ids):
+    list_counts = swarm_matrix.row_sums()
+    list_num_samples = swarm_matrix.row_nnz()
+
+    for index in range(len(list_swarm_ids)):
+        swarm_id = list_swarm_ids[index]
+        dict_swarm_counts[swarm_id] = list_counts[index]
+        if list_num_samples[index]:
+            dict_swarm_num_samples[swarm_id] = list_num_samples[index]
+
 def calc_swarm_counts():
-    global dict_swarm_counts
-    global dict_swarm_sample_counts
-    global dict_swarm_num_samples
-    
-    for id in dict_id_swarm:
-        swarm_id = dict_id_swarm[id]
-        for i in range(len(sample_list)):
-            dict_swarm_sample_counts[swarm_id, i] = dict_swarm_sample_counts.get((swarm_id, i), 0) + dict_id_sample_counts.get((id, i),0)
-            dict_swarm_counts[swarm_id] = dict_swarm_counts.get(swarm_id, 0) + dict_id_sample_counts.get((id, i),0)
+    global swarm_matrix
+
+    # amplicon count rows are summed into OTU rows
+    seed_groups, list_swarm_ids = number_swarms()
+    row_groups = array.array(happymatrix.int64_typecode, [-1]) * len(amplicon_ids)
+    for index in range(len(amplicon_ids)):
+        if amplicon_swarm[index] >= 0:
+            row_groups[index] = seed_groups[amplicon_swarm[index]]
+
+    amplicon_matrix = happymatrix.coo_to_csr(amplicon_coo, len(amplicon_ids), len(sample_list))
+    swarm_matrix = happymatrix.group_rows(amplicon_matrix, row_groups, len(list_swarm_ids))
+    set_swarm_totals(list_swarm_ids)
+
+def group_count_lines(counts_reader, seed_groups):
+    # clustered counts rows as "OTU number<tab>column:count ..." lines; amplicon totals are kept for recruitment
+    for id, fields, items in counts_reader.rows():
+        index = amplicon_index(id)
+        if index < 0 or amplicon_swarm[index] < 0:
+            continue
+        items = list(items)
+        for i, count in items:
+            amplicon_counts[index] += count
+        if items:
+            yield str(seed_groups[amplicon_swarm[index]]) + "\t" + " ".join(str(i) + ":" + str(count) for i, count in items) + "\n"
+
+def line_group(line):
+    return int(line[:line.index("\t")])
+
+def rare_group_count_lines(fasta_file, rare_fasta_file, rare_counts_file, seed_groups):
+    # recruitment ranks hits by their derep totals, so it runs once the derep rows have been consumed
+    if verbose:
+        print("Reading rare FASTA file: " + rare_fasta_file, file=sys.stderr)
+    recruit_rare(clustered_seq_ids(fasta_file), fasta_records(rare_fasta_file))
+    for line in group_count_lines(open_rare_counts(rare_counts_file), seed_groups):
+        yield line
+
+def stream_swarm_counts(counts_file, fasta_file, rare_fasta_file, rare_counts_file, tmp_dir):
+    # merge-join: counts rows keyed by OTU number are sorted externally, and each OTU's
+    # row is summed as its lines arrive, so only OTU counts are held in memory
+    global sample_list
+    global swarm_matrix
 
-    for swarm_id in dict_swarm_counts:
-        for i in range(len(sample_list)):
-            if (swarm_id, i) in dict_swarm_sample_counts:
-                dict_swarm_num_samples[swarm_id] = dict_swarm_num_samples.get(swarm_id, 0) + 1
+    seed_groups, list_swarm_ids = number_swarms()
+    counts_reader = happymatrix.CountsReader(counts_file)
 
+    if verbose:
+        print("Streaming counts file: " + counts_file, file=sys.stderr)
+
+    sample_list = counts_reader.col_names
+    lines = group_count_lines(counts_reader, seed_groups)
+    if rare_fasta_file:
+        lines = itertools.chain(lines, rare_group_count_lines(fasta_file, rare_fasta_file, rare_counts_file, seed_groups))
+
+    ngroups = len(list_swarm_ids)
+    indptr = happymatrix.int64_array(ngroups + 1)
+    indices = happymatrix.int32_array()
+    data = happymatrix.int64_array()
+    sums = happymatrix.int64_array(len(sample_list))
+    mark = happymatrix.int64_array(len(sample_list))
+    next_group = 0
+    for group, group_lines in itertools.groupby(happysort.sort_lines(lines, line_group, tmp_dir, stream_sort_lines), line_group):
+        cols = []
+        for line in group_lines:
+            for item in line.rstrip().split("\t")[1].split(" "):
+                col, count = item.split(":")
+                col = int(col)
+                if mark[col] != group + 1:
+                    mark[col] = group + 1
+                    sums[col] = int(count)
+                    cols.append(col)
+                else:
+                    sums[col] += int(count)
+        while next_group < group:
+            indptr[next_group+1] = len(data)
+            next_group += 1
+        cols.sort()
+        for col in cols:
+            indices.append(col)
+            data.append(sums[col])
+        indptr[group+1] = len(data)
+        next_group = group + 1
+    while next_group < ngroups:
+        indptr[next_group+1] = len(data)
+        next_group += 1
+
+    swarm_matrix = happymatrix.CountsMatrix(ngroups, len(sample_list), indptr, indices, data)
+    set_swarm_totals(list_swarm_ids)
+
+def intern_id(id):
+    # amplicon IDs are numbered once, in order of first appearance; counts rows and OTU joins use the number
+    index = dict_amplicon_index.get(id)
+    if index is None:
+        # the list holds the dict's own key strings, so each ID is stored once
+        index = len(amplicon_ids)
+        dict_amplicon_index[id] = index
+        amplicon_ids.append(id)
+        amplicon_swarm.append(-1)
+        amplicon_counts.append(0)
+    return index
+
+def amplicon_index(id):
+    # number of an interned ID, or -1
+    return dict_amplicon_index.get(id, -1)
+
+def add_amplicon_counts(id, items):
+    row = intern_id(id)
+    for i, count in items:
+        amplicon_coo.append(row, i, count)
+        amplicon_counts[row] += count
 
 def read_counts(counts_file):
-    global dict_id_counts
-    global dict_id_sample_counts
     global sample_list
     
     if counts_file:
-        in_handle = happyfile.hopen_or_else(counts_file)
+        counts_reader = happymatrix.CountsReader(counts_file)
         
         if verbose:
             print("Reading counts file: " + counts_file, file=sys.stderr)
         
-        firstline = 1
-        while 1:
-            line = in_handle.readline()
-            if not line:
-                break
-            line = line.rstrip()
-            
-            if firstline:
-                sample_list = line.split("\t")[1:]
-            else:
-                cols = line.split("\t")
-                for i in range(1, len(cols)):
-                    dict_id_sample_counts[cols[0], i-1] = int(cols[i])
-                    dict_id_counts[cols[0]] = dict_id_counts.get(cols[0], 0) + int(cols[i])
-            
-            firstline = 0
-                
-        in_handle.close()
-
-        calc_swarm_counts()
-
-def get_swarms(fasta_file, swarm_file, cpus):
-    global dict_id_swarm
-    
-    if fasta_file and not os.path.exists(swarm_file):
-        print("[swarm_map] running swarm", file=sys.stderr)
+        sample_list = counts_reader.col_names
+        for id, fields, items in counts_reader.rows():
+            add_amplicon_counts(id, items)
 
-        if cpus < 1:
-            cpus = 1
-        
-        cmd = " ".join(["swarm -f -t", str(cpus), "-o", swarm_file, fasta_file])
-        
-        if verbose:
-            print(cmd, file=sys.stderr)
-        else:
-            cmd += " &>/dev/null"
-        
-        rc = os.system(cmd)
-        if rc != 0:
-            print("[swarm_map] ERROR: swarm", file=sys.stderr)
-            sys.exit(2)
+def fasta_records(fasta_file):
+    in_handle = happyfile.hopen_or_else(fasta_file)
 
-    in_handle1 = happyfile.hopen_or_else(fasta_file)
+    id = ""
+    seq = ""
     while 1:
-        line = in_handle1.readline()
+        line = in_handle.readline()
         if not line:
             break
         line = line.rstrip()
 
         if line.startswith(">"):
+            if seq:
+                yield id, seq
             id = line[1:]
-            # set any IDs not returned by swarm, to their own cluster
-            dict_id_swarm[id] = id
-    in_handle1.close()
+            seq = ""
+        else:
+            seq += re.sub('\s', '', line)
+
+    if seq:
+        yield id, seq
+    in_handle.close()
+
+def clustered_seq_ids(fasta_file):
+    # sequence -> amplicon number of every clustered derep sequence, streamed from the FASTA
+    dict_seq_id = {}
+    for id, seq in fasta_records(fasta_file):
+        index = amplicon_index(id)
+        if index >= 0 and amplicon_swarm[index] >= 0:
+            dict_seq_id[seq.lower()] = index
+    return dict_seq_id
+
+def recruit_rare(dict_seq_id, rare_records):
+    # rare uniques join the OTU of their most abundant clustered sequence one difference away
+    global dict_swarm_recruits
+
+    recruited = 0
+    total = 0
+    for rare_id, seq in rare_records:
+        total += 1
+        hits = [dict_seq_id[x] for x in happyswarm.microvariants(seq.lower()) if x in dict_seq_id]
+        if hits:
+            best = min(hits, key=lambda index: (-amplicon_counts[index], amplicon_ids[index]))
+            rare = intern_id(rare_id)
+            amplicon_swarm[rare] = amplicon_swarm[best]
+            dict_swarm_recruits.setdefault(amplicon_swarm[best], []).append(rare)
+            recruited += 1
 
-    in_handle2 = happyfile.hopen_or_else(swarm_file)
     if verbose:
-        print("Reading swarm file: " + swarm_file, file=sys.stderr)
-    
+        print("Recruited rare uniques: " + str(recruited) + " of " + str(total), file=sys.stderr)
+
+def open_rare_counts(rare_counts_file):
+    counts_reader = happymatrix.CountsReader(rare_counts_file)
+
+    if verbose:
+        print("Reading rare counts file: " + rare_counts_file, file=sys.stderr)
+
+    if counts_reader.col_names != sample_list:
+        print("[swarm_map] ERROR: rare counts samples differ from: " + rare_counts_file, file=sys.stderr)
+        sys.exit(2)
+    return counts_reader
+
+def read_rare_counts(rare_counts_file):
+    for id, fields, items in open_rare_counts(rare_counts_file).rows():
+        index = amplicon_index(id)
+        if index >= 0 and amplicon_swarm[index] >= 0:
+            add_amplicon_counts(id, items)
+
+def tee_swarm_output(process, swarm_file, swarm_members):
+    # swarm lines are written to the swarm file as the program produces them, and parsed into swarm_members:
+    # a flat array of each OTU's members, seed first, with the offset of each OTU in starts.  A member is its
+    # amplicon number, or, if the main thread has not interned its ID yet, -1 - its position in pending IDs,
+    # so that amplicons are still numbered in the order the main thread reads them
+    out_handle = happyfile.hopen_write_or_else(swarm_file)
+    for line in iter(process.stdout.readline, ''):
+        out_handle.write(line)
+        if swarm_members:
+            members, starts, pending_ids = swarm_members
+            id_list = re.split('\s', line.rstrip())
+            if id_list[0]:
+                starts.append(len(members))
+                for id in id_list:
+                    index = dict_amplicon_index.get(id, -1)
+                    if index < 0:
+                        pending_ids.append(id)
+                        index = -len(pending_ids)
+                    members.append(index)
+    out_handle.close()
+
+def start_swarm(fasta_file, swarm_file, cpus, native=False, fastidious=True, parse=True):
+    # the swarm program is started on a pipe, so that counts and FASTA are read while it runs,
+    # and its OTUs parsed (parse) while it writes them
+    if not fasta_file or os.path.exists(swarm_file) or native:
+        return None
+
+    print("[swarm_map] running swarm", file=sys.stderr)
+
+    cmd = (["swarm"], ["swarm", "-f"])[fastidious] + ["-t", str(max(1, cpus)), fasta_file]
+    if verbose:
+        print(" ".join(cmd), file=sys.stderr)
+        err_handle = None
+    else:
+        err_handle = open(os.devnull, 'w')
+
+    try:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err_handle, universal_newlines=True)
+    except OSError:
+        print("[swarm_map] ERROR: swarm", file=sys.stderr)
+        sys.exit(2)
+
+    swarm_members = None
+    if parse:
+        swarm_members = (happymatrix.int64_array(), happymatrix.int64_array(), [])
+    thread = threading.Thread(target=tee_swarm_output, args=(process, swarm_file + ".tmp", swarm_members))
+    thread.start()
+    return process, thread, swarm_members
+
+def wait_swarm(swarm_job, swarm_file):
+    # once the swarm program has finished, its swarm file is put in place; returns its parsed OTUs
+    process, thread, swarm_members = swarm_job
+    thread.join()
+    if process.wait() != 0:
+        os.remove(swarm_file + ".tmp")
+        print("[swarm_map] ERROR: swarm", file=sys.stderr)
+        sys.exit(2)
+    os.rename(swarm_file + ".tmp", swarm_file)
+    return swarm_members
+
+def swarm_id_lists(swarm_file):
+    # the IDs of each swarm line, seed first, streamed from the swarm file
+    in_handle = happyfile.hopen_or_else(swarm_file)
     while 1:
-        line = in_handle2.readline()
+        line = in_handle.readline()
         if not line:
             break
-        line = line.rstrip()
+        yield re.split('\s', line.rstrip())
+    in_handle.close()
+
+def merge_swarm_members(swarm_members):
+    # the OTUs parsed while swarm ran are assigned, interning the IDs that were pending
+    members, starts, pending_ids = swarm_members
+    starts.append(len(members))
+    for k in range(len(starts) - 1):
+        seed = -1
+        for i in range(starts[k], starts[k+1]):
+            index = members[i]
+            if index < 0:
+                index = intern_id(pending_ids[-1 - index])
+            if seed < 0:
+                seed = index
+            amplicon_swarm[index] = seed
+
+def get_swarms(fasta_file, swarm_file, cpus, native=False, fastidious=True, swarm_job=None):
+    if cpus < 1:
+        cpus = 1
+
+    if fasta_file and not os.path.exists(swarm_file) and native:
+        print("[swarm_map] running native swarm", file=sys.stderr)
+        happyswarm.run_swarm(fasta_file, swarm_file, cpus, fastidious)
+
+    for id, seq in fasta_records(fasta_file):
+        # set any IDs not returned by swarm, to their own cluster
+        index = intern_id(id)
+        amplicon_swarm[index] = index
+
+    if swarm_job:
+        merge_swarm_members(wait_swarm(swarm_job, swarm_file))
+        return
 
-        id_list = re.split('\s', line)
+    if verbose:
+        print("Reading swarm file: " + swarm_file, file=sys.stderr)
+
+    # each line's IDs are interned as it is read, so only their numbers are kept
+    for id_list in swarm_id_lists(swarm_file):
+        if not id_list[0]:
+            continue
+        seed = intern_id(id_list[0])
         for id in id_list:
-            dict_id_swarm[id] = id_list[0]
-    in_handle2.close()
+            amplicon_swarm[intern_id(id)] = seed
 
+def id_hash(id):
+    # derep ID without its abundance suffix: the SHA-1 of the sequence
+    return re.sub('(_|;size=)\d+;?$', '', id)
+
+def seq_hash(seq):
+    return hashlib.sha1(seq.encode()).hexdigest()
+
+def read_membership(membership_file):
+    # sequence hash -> (OTU ID, abundance) of each member of an existing swarm file
+    dict_hash_otu = {}
+    list_otus = []
+    in_handle = happyfile.hopen_or_else(membership_file)
 
-def read_swarm_fasta(fasta_file):
-    in_handle = happyfile.hopen_or_else(fasta_file)
-    
     if verbose:
-        print("Reading FASTA file: " + fasta_file, file=sys.stderr)
-        
-    id = ""
-    seq = ""
+        print("Reading existing swarm file: " + membership_file, file=sys.stderr)
+
     while 1:
         line = in_handle.readline()
         if not line:
             break
-        line = line.rstrip()
-        
-        if line.startswith(">"):
-            if seq:
-                dict_swarm_seq[id] = seq
-            id = line[1:]
-            seq = ""
+        id_list = re.split('\s', line.rstrip())
+        if id_list[0]:
+            list_otus.append(id_list[0])
+            for id in id_list:
+                dict_hash_otu[id_hash(id)] = (id_list[0], happyswarm.amplicon_abundance(id) or 0)
+    in_handle.close()
+    return dict_hash_otu, list_otus
+
+def update_swarms(fasta_file, membership_file, swarm_file, cpus, native=False, fastidious=True):
+    # amplicons identical or one difference from a member of an existing OTU join it, and only the remainder
+    # is clustered; an OTU keeps its seed, written with its current ID so its sequence hash is unchanged
+    dict_hash_otu, list_otus = read_membership(membership_file)
+    dict_otu_members = {}
+    dict_seed_id = {}
+    remainder_fasta_file = swarm_file + ".new.fa"
+    out_handle = happyfile.hopen_write_or_else(remainder_fasta_file)
+    assigned = 0
+    remainder = 0
+    for id, seq in fasta_records(fasta_file):
+        seq = seq.lower()
+        hit = dict_hash_otu.get(seq_hash(seq))
+        if hit is not None and id_hash(hit[0]) == id_hash(id):
+            dict_seed_id[hit[0]] = id
+        elif hit is None:
+            hits = [dict_hash_otu[h] for h in (seq_hash(x) for x in happyswarm.microvariants(seq)) if h in dict_hash_otu]
+            if hits:
+                hit = min(hits, key=lambda otu: (-otu[1], otu[0]))
+        if hit is None:
+            print(">" + id + "\n" + seq, file=out_handle)
+            remainder += 1
         else:
-            seq += re.sub('\s', '', line)
+            dict_otu_members.setdefault(hit[0], []).append(id)
+            assigned += 1
+    out_handle.close()
+    dict_hash_otu = None
 
-    if seq:
-        dict_swarm_seq[id] = seq
-    in_handle.close()
+    if verbose:
+        print("Assigned to existing OTUs: " + str(assigned) + ", clustering: " + str(remainder), file=sys.stderr)
+
+    remainder_swarm_file = swarm_file + ".new.swarm"
+    if remainder:
+        if native:
+            happyswarm.run_swarm(remainder_fasta_file, remainder_swarm_file, cpus, fastidious)
+        else:
+            wait_swarm(start_swarm(remainder_fasta_file, remainder_swarm_file, cpus, native, fastidious, False), remainder_swarm_file)
+    os.remove(remainder_fasta_file)
+
+    out_handle = happyfile.hopen_write_or_else(swarm_file)
+    for otu in list_otus:
+        if otu in dict_seed_id:
+            seed_id = dict_seed_id[otu]
+            print(" ".join([seed_id] + [id for id in dict_otu_members[otu] if id != seed_id]), file=out_handle)
+        elif otu in dict_otu_members:
+            # without its seed sequence, an OTU is named by its most abundant member
+            members = sorted(dict_otu_members[otu], key=lambda id: -(happyswarm.amplicon_abundance(id) or 0))
+            print(" ".join(members), file=out_handle)
+    if remainder:
+        in_handle = happyfile.hopen_or_else(remainder_swarm_file)
+        for line in in_handle:
+            out_handle.write(line)
+        in_handle.close()
+        os.remove(remainder_swarm_file)
+    out_handle.close()
+
+def read_swarm_fasta(fasta_file):
+    # only OTU seed sequences are kept, the rest are streamed past
+    if verbose:
+        print("Reading FASTA file: " + fasta_file, file=sys.stderr)
+
+    for id, seq in fasta_records(fasta_file):
+        index = amplicon_index(id)
+        if index >= 0 and amplicon_swarm[index] == index:
+            dict_swarm_seq_index[id] = swarm_seqs.append(seq)
+
+def write_map(output_map_file, swarm_file, min_samples, min_count):
+    # the map is streamed in swarm file order, one OTU at a time, with any recruited rare uniques after its members;
+    # FASTA sequences missing from the swarm file are their own OTUs, written last
+    out_handle = happyfile.hopen_write_or_else(output_map_file)
+
+    if verbose:
+        print("Writing map file: " + output_map_file, file=sys.stderr)
+
+    written = set()
+    for id_list in swarm_id_lists(swarm_file):
+        swarm_id = id_list[0]
+        if not swarm_id or swarm_id in written:
+            continue
+        written.add(swarm_id)
+        if dict_swarm_num_samples.get(swarm_id, 1) >= min_samples and dict_swarm_counts.get(swarm_id, 0) >= min_count:
+            seed = amplicon_index(swarm_id)
+            for id in id_list:
+                index = amplicon_index(id)
+                if index >= 0 and amplicon_swarm[index] == seed:
+                    print(swarm_id + "\t" + id, file=out_handle)
+            for index in dict_swarm_recruits.get(seed, []):
+                print(swarm_id + "\t" + amplicon_ids[index], file=out_handle)
 
-def write_swarms(output_fasta_file, output_counts_file, output_map_file, min_samples, min_count):
+    for swarm_id in dict_swarm_counts:
+        if not swarm_id in written and dict_swarm_num_samples[swarm_id] >= min_samples and dict_swarm_counts[swarm_id] >= min_count:
+            print(swarm_id + "\t" + swarm_id, file=out_handle)
+            for index in dict_swarm_recruits.get(amplicon_index(swarm_id), []):
+                print(swarm_id + "\t" + amplicon_ids[index], file=out_handle)
+
+    out_handle.close()
+
+def write_swarms(output_fasta_file, output_counts_file, output_map_file, swarm_file, min_samples, min_count):
     # set at least one sample where counts not given
     for swarm_id in dict_swarm_counts:
         if not swarm_id in dict_swarm_num_samples:
@@ -191,49 +530,256 @@ def write_swarms(output_fasta_file, output_counts_file, output_map_file, min_sam
 
     for swarm_id in dict_swarm_counts:
         if dict_swarm_num_samples[swarm_id] >= min_samples and dict_swarm_counts[swarm_id] >= min_count:
-            print(">" + swarm_id + "\n" + dict_swarm_seq[swarm_id], file=out_handle1)
+            print(">" + swarm_id + "\n" + swarm_seqs[dict_swarm_seq_index[swarm_id]], file=out_handle1)
 
     out_handle1.close()
 
     if output_counts_file:
-        out_handle2 = happyfile.hopen_write_or_else(output_counts_file)
-
-        if verbose:
-            print("Writing counts file: " + output_counts_file, file=sys.stderr)
-
-        column_names = ['id']
+        column_names = []
         for name in sample_list:
             if name in dict_sample_name:
                 column_names.append(dict_sample_name[name])
             else:
                 column_names.append(name)
 
-        print("\t".join(column_names), file=out_handle2)
+        counts_writer = happymatrix.CountsWriter(output_counts_file, column_names)
+
+        if verbose:
+            print("Writing counts file: " + output_counts_file, file=sys.stderr)
 
         for swarm_id in dict_swarm_counts:
             if dict_swarm_num_samples[swarm_id] >= min_samples and dict_swarm_counts[swarm_id] >= min_count:
-                samplecounts = []
-                for i in range(len(sample_list)):
-                    samplecounts.append(dict_swarm_sample_counts.get((swarm_id, i), 0))
-                print(swarm_id + "\t" + "\t".join(str(x) for x in samplecounts), file=out_handle2)
+                counts_writer.write_row(swarm_id, swarm_matrix.row_items(dict_swarm_index[swarm_id]))
 
-        out_handle2.close()
+        counts_writer.close()
 
     if output_map_file:
-        out_handle3 = happyfile.hopen_write_or_else(output_map_file)
-            
-        if verbose:
-            print("Writing map file: " + output_map_file, file=sys.stderr)
-
-        for id in sorted(dict_id_swarm, key=dict_id_swarm.get):
-            swarm_id = dict_id_swarm[id]
-            if dict_swarm_num_samples[swarm_id] >= min_samples and dict_swarm_counts[swarm_id] >= min_count:
-                print(swarm_id + "\t" + id, file=out_handle3)
-
-        out_handle3.close()
+        write_map(output_map_file, swarm_file, min_samples, min_count)
+
+def set_test_amplicons(list_id_seeds):
+    # interns (ID, seed ID) pairs in order, a blank seed ID leaving the amplicon unclustered
+    global amplicon_ids
+    global dict_amplicon_index
+    global amplicon_swarm
+    global amplicon_counts
+    global amplicon_coo
+    dict_amplicon_index = {}
+    amplicon_ids = []
+    amplicon_swarm = happymatrix.int64_array()
+    amplicon_counts = happymatrix.int64_array()
+    amplicon_coo = happymatrix.CountsCOO()
+    for id, seed_id in list_id_seeds:
+        index = intern_id(id)
+        if seed_id:
+            amplicon_swarm[index] = intern_id(seed_id)
+
+def test_swarm_id(id):
+    index = amplicon_index(id)
+    if index >= 0 and amplicon_swarm[index] >= 0:
+        return amplicon_ids[amplicon_swarm[index]]
+    return ""
+
+def test_swarm_pipe():
+    retval = True
+    # b_1 is interned before swarm writes its line, c_2 after, and a_3 only when the OTUs are merged
+    set_test_amplicons([("b_1", "")])
+    tmp_dir = tempfile.mkdtemp()
+    swarm_file = os.path.join(tmp_dir, "test.swarm")
+    process = subprocess.Popen([sys.executable, "-c", "print('a_3 b_1'); print('c_2')"], stdout=subprocess.PIPE, universal_newlines=True)
+    swarm_members = (happymatrix.int64_array(), happymatrix.int64_array(), [])
+    tee_swarm_output(process, swarm_file, swarm_members)
+    process.wait()
+    intern_id("c_2")
+    merge_swarm_members(swarm_members)
+    lines = open(swarm_file).read().splitlines()
+    shutil.rmtree(tmp_dir)
+    if lines == ["a_3 b_1", "c_2"] and list(amplicon_ids) == ["b_1", "c_2", "a_3"] and [test_swarm_id(x) for x in ["a_3", "b_1", "c_2"]] == ["a_3", "a_3", "c_2"]:
+        print("[swarm_map] test_swarm_pipe: passed", file=sys.stderr)
+    else:
+        print("[swarm_map] test_swarm_pipe: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_recruit():
+    global dict_swarm_recruits
+    retval = True
+    set_test_amplicons([("a_10", "a_10"), ("b_5", "b_5"), ("c_7", "c_7")])
+    for id, count in [("a_10", 10), ("b_5", 5), ("c_7", 7)]:
+        amplicon_counts[amplicon_index(id)] = count
+    dict_seq_id = {"acgtacgtac" : amplicon_index("a_10"), "acgtacgtaa" : amplicon_index("b_5"), "ttttgggg" : amplicon_index("c_7")}
+    dict_swarm_recruits = {}
+    # substitution, deletion, insertion, two differences, and a tie broken by abundance
+    recruit_rare(dict_seq_id, [("r1", "acgtccgtac"), ("r2", "tttgggg"), ("r3", "tttttgggg"), ("r4", "aaaaaaaa"), ("r5", "acgtacgtag")])
+    if [test_swarm_id(x) for x in ["r1", "r2", "r3", "r4", "r5"]] == ["a_10", "c_7", "c_7", "", "a_10"]:
+        print("[swarm_map] test_recruit: passed", file=sys.stderr)
+    else:
+        print("[swarm_map] test_recruit: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_swarm_counts():
+    global sample_list
+    global dict_swarm_index
+    global dict_swarm_counts
+    global dict_swarm_num_samples
+    retval = True
+    sample_list = ["s1", "s2", "s3"]
+    set_test_amplicons([("a_4", "a_4"), ("b_3", "a_4"), ("c_2", "c_2"), ("d_1", "a_4"), ("e_1", "e_1")])
+    dict_swarm_index = {}
+    dict_swarm_counts = {}
+    dict_swarm_num_samples = {}
+    for id, items in [("a_4", [(0, 3), (2, 1)]), ("b_3", [(2, 3)]), ("c_2", [(1, 2)]), ("d_1", [(1, 1)]), ("x_9", [(0, 9)])]:
+        add_amplicon_counts(id, items)
+    calc_swarm_counts()
+    rows = [list(swarm_matrix.row_items(dict_swarm_index[x])) for x in ["a_4", "c_2", "e_1"]]
+    if rows == [[(0, 3), (1, 1), (2, 4)], [(1, 2)], []] and dict_swarm_counts == {"a_4" : 8, "c_2" : 2, "e_1" : 0} and dict_swarm_num_samples == {"a_4" : 3, "c_2" : 1}:
+        print("[swarm_map] test_swarm_counts: passed", file=sys.stderr)
+    else:
+        print("[swarm_map] test_swarm_counts: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_stream_counts():
+    global stream_sort_lines
+    global dict_swarm_index
+    global dict_swarm_counts
+    global dict_swarm_num_samples
+    retval = True
+    # as test_swarm_counts, merge-joined through sorted runs of two lines
+    set_test_amplicons([("a_4", "a_4"), ("b_3", "a_4"), ("c_2", "c_2"), ("d_1", "a_4"), ("e_1", "e_1")])
+    dict_swarm_index = {}
+    dict_swarm_counts = {}
+    dict_swarm_num_samples = {}
+    tmp_dir = tempfile.mkdtemp()
+    counts_file = os.path.join(tmp_dir, "test.counts")
+    out_handle = open(counts_file, 'w')
+    out_handle.write("id\ts1\ts2\ts3\na_4\t3\t0\t1\nb_3\t0\t0\t3\nc_2\t0\t2\t0\nd_1\t0\t1\t0\nx_9\t9\t0\t0\n")
+    out_handle.close()
+    sort_lines = stream_sort_lines
+    stream_sort_lines = 2
+    stream_swarm_counts(counts_file, "", "", "", tmp_dir)
+    stream_sort_lines = sort_lines
+    shutil.rmtree(tmp_dir)
+    rows = [list(swarm_matrix.row_items(dict_swarm_index[x])) for x in ["a_4", "c_2", "e_1"]]
+    if rows == [[(0, 3), (1, 1), (2, 4)], [(1, 2)], []] and dict_swarm_counts == {"a_4" : 8, "c_2" : 2, "e_1" : 0} and sample_list == ["s1", "s2", "s3"]:
+        print("[swarm_map] test_stream_counts: passed", file=sys.stderr)
+    else:
+        print("[swarm_map] test_stream_counts: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_native_swarm():
+    retval = True
+    # a > b > c > d one difference apart; h_5 is next to d_1 but more abundant (breaking); g_1 is two from e_30
+    list_ids = ["a_20", "b_3", "c_2", "d_1", "e_30", "f_1", "g_1", "h_5"]
+    seqs = ["acgtacgtac", "acgtacgtaa", "acgtacgaaa", "ccgtacgaaa", "ttttgggggg", "gggggggggg", "ttttggccgg", "ccgttcgaaa"]
+    swarms = [[list_ids[i] for i in members] for members in happyswarm.cluster(list_ids, seqs, 1, False)]
+    grafted = [[list_ids[i] for i in members] for members in happyswarm.cluster(list_ids, seqs, 1, True)]
+    if swarms == [["e_30"], ["a_20", "b_3", "c_2", "d_1"], ["h_5"], ["f_1"], ["g_1"]] and grafted == [["e_30", "g_1"], ["a_20", "b_3", "c_2", "d_1"], ["h_5"], ["f_1"]]:
+        print("[swarm_map] test_native_swarm: passed", file=sys.stderr)
+    else:
+        print("[swarm_map] test_native_swarm: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_spawn_swarm():
+    retval = True
+    # spawned workers each have their own str hash seed, so the fastidious Bloom filter must not depend on it
+    list_ids = ["a_20", "b_3", "c_2", "d_1", "e_30", "f_1", "g_1", "h_5"]
+    seqs = ["acgtacgtac", "acgtacgtaa", "acgtacgaaa", "ccgtacgaaa", "ttttgggggg", "gggggggggg", "ttttggccgg", "ccgttcgaaa"]
+    serial = happyswarm.cluster(list_ids, seqs, 1, True)
+    parallel = serial
+    if hasattr(multiprocessing, 'set_start_method'):
+        start_method = multiprocessing.get_start_method()
+        batch_size = happyswarm.batch_size
+        multiprocessing.set_start_method('spawn', force=True)
+        happyswarm.batch_size = 2
+        parallel = happyswarm.cluster(list_ids, seqs, 2, True)
+        happyswarm.batch_size = batch_size
+        multiprocessing.set_start_method(start_method, force=True)
+    if parallel == serial:
+        print("[swarm_map] test_spawn_swarm: passed", file=sys.stderr)
+    else:
+        print("[swarm_map] test_spawn_swarm: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_unoise():
+    retval = True
+    # b_10 is one difference from a_100 (skew 1/10), c_20 too but at skew 1/5; d_3 is two from a_100 (skew 3/100),
+    # e_4 two from a_100 at skew 1/25; f_2 is one from c_20 (skew 1/10) and two from a_100
+    list_ids = ["a_100", "b_10", "c_20", "d_3", "e_4", "f_2"]
+    seqs = ["acgtacgtacgtacgt", "acgtacgtacgaacgt", "acgtacctacgtacgt", "tcgtacgtacgtacgg", "acgtacgtacgtac", "acgtacctacgtacgtt"]
+    asvs = [[list_ids[i] for i in members] for members in happyunoise.denoise(list_ids, seqs, 1)]
+    parallel = [[list_ids[i] for i in members] for members in happyunoise.denoise(list_ids, seqs, 2)]
+    if asvs == [["a_100", "b_10", "d_3"], ["c_20", "f_2"], ["e_4"]] and parallel == asvs and happyunoise.banded_distance(seqs[0], seqs[4], 2) == 2:
+        print("[swarm_map] test_unoise: passed", file=sys.stderr)
+    else:
+        print("[swarm_map] test_unoise: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_write_map():
+    global dict_swarm_counts
+    global dict_swarm_num_samples
+    global dict_swarm_recruits
+    retval = True
+    # OTU c_2 is below the minimum count; e_1 is missing from the swarm file; r_1 was recruited into a_4
+    set_test_amplicons([("a_4", "a_4"), ("b_1", "a_4"), ("c_2", "c_2"), ("d_1", "c_2"), ("e_1", "e_1"), ("r_1", "a_4")])
+    dict_swarm_counts = {"a_4" : 6, "c_2" : 1, "e_1" : 2}
+    dict_swarm_num_samples = {"a_4" : 2, "c_2" : 1, "e_1" : 1}
+    dict_swarm_recruits = {amplicon_index("a_4") : [amplicon_index("r_1")]}
+    tmp_dir = tempfile.mkdtemp()
+    swarm_file = os.path.join(tmp_dir, "test.swarm")
+    map_file = os.path.join(tmp_dir, "test.map")
+    out_handle = open(swarm_file, 'w')
+    out_handle.write("c_2 d_1\na_4 b_1\n")
+    out_handle.close()
+    write_map(map_file, swarm_file, 1, 2)
+    lines = open(map_file).read().splitlines()
+    shutil.rmtree(tmp_dir)
+    if lines == ["a_4\ta_4", "a_4\tb_1", "a_4\tr_1", "e_1\te_1"]:
+        print("[swarm_map] test_write_map: passed", file=sys.stderr)
+    else:
+        print("[swarm_map] test_write_map: failed", file=sys.stderr)
+        retval = False
+    return retval
+
+def test_update_swarms():
+    retval = True
+    # the seed of OTU a_10 now has 12 copies; x is one difference from b, y is new and z is one from y
+    seqs = {"a" : "acgtacgtac", "b" : "acgtacgtaa", "c" : "ggggttttcc", "x" : "acgtacgtga", "y" : "ttttaaaacc", "z" : "ttttaaaacg"}
+    ids = dict((x, seq_hash(seqs[x])) for x in seqs)
+    tmp_dir = tempfile.mkdtemp()
+    membership_file = os.path.join(tmp_dir, "old.swarm")
+    fasta_file = os.path.join(tmp_dir, "derep.fa")
+    swarm_file = os.path.join(tmp_dir, "new.swarm")
+    out_handle = open(membership_file, 'w')
+    out_handle.write(ids["a"] + "_10 " + ids["b"] + "_2\n" + ids["c"] + "_4\n")
+    out_handle.close()
+    out_handle = open(fasta_file, 'w')
+    for x, count in [("a", 12), ("y", 6), ("b", 3), ("x", 1), ("z", 1)]:
+        out_handle.write(">" + ids[x] + "_" + str(count) + "\n" + seqs[x] + "\n")
+    out_handle.close()
+    update_swarms(fasta_file, membership_file, swarm_file, 1, True, True)
+    lines = open(swarm_file).read().splitlines()
+    # each OTU seed of the updated swarm file is in the FASTA, so its sequence is found
+    set_test_amplicons([])
+    dict_swarm_seq_index.clear()
+    get_swarms(fasta_file, swarm_file, 1)
+    read_swarm_fasta(fasta_file)
+    seeds = sorted(dict_swarm_seq_index)
+    shutil.rmtree(tmp_dir)
+    if lines == [" ".join([ids["a"] + "_12", ids["b"] + "_3", ids["x"] + "_1"]), " ".join([ids["y"] + "_6", ids["z"] + "_1"])] and seeds == sorted([ids["a"] + "_12", ids["y"] + "_6"]):
+        print("[swarm_map] test_update_swarms: passed", file=sys.stderr)
+    else:
+        print("[swarm_map] test_update_swarms: failed", file=sys.stderr)
+        retval = False
+    return retval
 
 def test_all():
-    print("[swarm_map] test_all: passed", file=sys.stderr)
+    if not (test_swarm_pipe() and test_recruit() and test_swarm_counts() and test_stream_counts() and test_native_swarm() and test_spawn_swarm() and test_unoise() and test_write_map() and test_update_swarms()):
+        sys.exit(2)
 
 ###
 
@@ -245,14 +791,30 @@ def main(argv):
         "Usage: " + os.path.basename(argv[0]) + " (options)",
         "   -f file        : dereplicated FASTA (required)",
         "   -s file        : swarm file (required)",
-        "   -d file        : dereplicated counts table (required if -c)",
+        "   -d file        : dereplicated counts table, TSV or .npz (required if -c)",
         "   -o file        : output FASTA file (default: stdout)",
-        "   -c file        : output swarm OTU counts file (requires -d)",
+        "   -c file        : output swarm OTU counts file, .npz for sparse binary (requires -d)",
         "   -m file        : output ID map table",
         "   -n file        : sample names file",
         "   -l int         : minimum samples (default: 1, requires -d if > 1)",
         "   -t int         : minimum total count (default: 1)",
         "   -x, --cpus int : number of processes to run swarm (default: 1)",
+        "   --native       : cluster with the built-in swarm (d=1) engine, instead of the swarm program",
+        "   --no_fastidious : skip fastidious grafting of light swarms (default: on)",
+        "   --unoise       : denoise into exact sequence variants (ASVs, UNOISE abundance skew) instead of",
+        "                    swarm OTUs; the swarm file (-s) then lists each ASV's centroid and its errors",
+        "   --stream_counts : merge-join counts to OTUs through an external sort of counts rows by OTU, holding",
+        "                    OTU but not amplicon counts in memory (requires -d; temporary files next to -s)",
+        "   --unoise_alpha float : UNOISE alpha, skew of d differences up to 1 / 2^(alpha * d + 1) (default: 2.0)",
+        "   -u file        : existing swarm file to update: amplicons identical or one difference from its",
+        "                    members join those OTUs, keeping their seeds, and only the rest are clustered",
+        "                    (swarm format IDs, the derep should include the earlier samples)",
+        "   --partitions int : write int FASTA partitions of independent amplicon groups (<swarm file>.partN.fa),",
+        "                    to cluster on separate nodes without fastidious, then exit; their swarm files",
+        "                    concatenated make the swarm file (-s)",
+        "   -r file        : rare uniques FASTA (fasta_dereplicate --rare_fa), recruited into OTUs",
+        "                    one substitution or indel away from a clustered sequence (requires -d, -e)",
+        "   -e file        : rare uniques counts table (fasta_dereplicate --rare_counts)",
         "   -h, --help     : help",
         "   -v, --verbose  : more information to stderr", ""])
 
@@ -267,9 +829,18 @@ def main(argv):
     min_count = 1
     min_samples = 1
     cpus = 1
+    rare_fasta_file = ""
+    rare_counts_file = ""
+    native = False
+    fastidious = True
+    partitions = 0
+    membership_file = ""
+    unoise = False
+    unoise_alpha = happyunoise.unoise_alpha
+    stream_counts = False
     
     try:
-        opts, args = getopt.getopt(argv[1:], "f:s:d:o:c:m:n:t:l:x:hv", ["cpus=", "help", "verbose", "test"])
+        opts, args = getopt.getopt(argv[1:], "f:s:d:o:c:m:n:t:l:x:r:e:u:hv", ["cpus=", "native", "no_fastidious", "unoise", "unoise_alpha=", "stream_counts", "partitions=", "help", "verbose", "test"])
     except getopt.GetoptError:
         print(help, file=sys.stderr)
         sys.exit(2)
@@ -301,6 +872,24 @@ def main(argv):
             min_count = int(re.sub('=','', arg))
         elif opt in ("-x", "--cpus"):
             cpus = int(re.sub('=','', arg))
+        elif opt == '--native':
+            native = True
+        elif opt == '--no_fastidious':
+            fastidious = False
+        elif opt == '--unoise':
+            unoise = True
+        elif opt == '--unoise_alpha':
+            unoise_alpha = float(re.sub('=','', arg))
+        elif opt == '--stream_counts':
+            stream_counts = True
+        elif opt == '--partitions':
+            partitions = int(re.sub('=','', arg))
+        elif opt == '-u':
+            membership_file = arg
+        elif opt == '-r':
+            rare_fasta_file = arg
+        elif opt == '-e':
+            rare_counts_file = arg
         elif opt in ("-v", "--verbose"):
             verbose = True
 
@@ -308,25 +897,60 @@ def main(argv):
         print(help, file=sys.stderr)
         sys.exit(2)
 
-    if (output_counts_file or min_samples > 1) and not counts_file:
+    if (output_counts_file or min_samples > 1 or stream_counts) and not counts_file:
         print(help + "\nDereplicated counts table required (-d)", file=sys.stderr)
         sys.exit(2)
 
+    if (rare_fasta_file or rare_counts_file) and not (rare_fasta_file and rare_counts_file and counts_file):
+        print(help + "\nRare uniques FASTA (-r) requires rare counts (-e) and dereplicated counts (-d)", file=sys.stderr)
+        sys.exit(2)
+
+    if unoise and membership_file:
+        print(help + "\nExisting swarm file (-u) cannot be updated with --unoise", file=sys.stderr)
+        sys.exit(2)
+
     if verbose:
         print("input fasta file:     " + fasta_file, file=sys.stderr)
+        if rare_fasta_file:
+            print("rare fasta file:      " + rare_fasta_file, file=sys.stderr)
+            print("rare counts file:     " + rare_counts_file, file=sys.stderr)
 
         print("\n".join([
             "output fasta file:    " + output_fasta_file,
             "output counts file:   " + output_counts_file,
             "output map file:      " + output_map_file,
             "minimum total counts: " + str(min_count),
-            "minimum samples:      " + str(min_samples)]), file=sys.stderr)
+            "minimum samples:      " + str(min_samples),
+            "swarm engine:         " + (("swarm", "native")[native], "unoise")[unoise],
+            "fastidious:           " + ("no", "yes")[fastidious]]), file=sys.stderr)
+
+    if partitions > 0:
+        for part_file in happyswarm.export_partitions(fasta_file, partitions, swarm_file):
+            print("[swarm_map] wrote partition: " + part_file, file=sys.stderr)
+        sys.exit()
 
     read_sample_names(sample_names_file)
-    get_swarms(fasta_file, swarm_file, cpus)
+    if unoise and not os.path.exists(swarm_file):
+        print("[swarm_map] running unoise", file=sys.stderr)
+        happyunoise.run_unoise(fasta_file, swarm_file, cpus, unoise_alpha)
+    if membership_file and not os.path.exists(swarm_file):
+        update_swarms(fasta_file, membership_file, swarm_file, cpus, native, fastidious)
+    swarm_job = start_swarm(fasta_file, swarm_file, cpus, native, fastidious)
+    if not stream_counts:
+        read_counts(counts_file)
+    get_swarms(fasta_file, swarm_file, cpus, native, fastidious, swarm_job)
     read_swarm_fasta(fasta_file)
-    read_counts(counts_file)
-    write_swarms(output_fasta_file, output_counts_file, output_map_file, min_samples, min_count)
+    if stream_counts:
+        stream_swarm_counts(counts_file, fasta_file, rare_fasta_file, rare_counts_file, os.path.dirname(swarm_file))
+    else:
+        if rare_fasta_file:
+            if verbose:
+                print("Reading rare FASTA file: " + rare_fasta_file, file=sys.stderr)
+            recruit_rare(clustered_seq_ids(fasta_file), fasta_records(rare_fasta_file))
+            read_rare_counts(rare_counts_file)
+        if counts_file:
+            calc_swarm_counts()
+    write_swarms(output_fasta_file, output_counts_file, output_map_file, swarm_file, min_samples, min_count)
 
 if __name__ == "__main__":
     main(sys.argv)